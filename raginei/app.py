@@ -14,16 +14,18 @@ import os
 import time
 import logging
 import threading
+import stat
 
 from werkzeug import exceptions
 from werkzeug.utils import import_string, cached_property
-from werkzeug.urls import Href
-from werkzeug.routing import Map, Rule, RequestRedirect
+from werkzeug.urls import Href, url_quote
+from werkzeug.routing import Map, Rule, RequestRedirect, ValidationError
 from werkzeug.local import Local, LocalManager, LocalProxy
 from werkzeug.wsgi import get_host
 
 from .wrappers import Request, Response, Found, MovedPermanently
-from .util import funcname, json_module, is_debug, measure_time
+from .util import funcname, json_module, is_debug, measure_time, Deadline, \
+  LRUCache
 from .ctx import Context
 
 __all__ = [
@@ -33,7 +35,8 @@ __all__ = [
   'request_middleware', 'response_middleware', 'routing_middleware',
   'view_middleware', 'exception_middleware', 'fetch', 'render', 'redirect',
   'render_json', 'render_text', 'render_blank_image', 'fetch_json', 'abort',
-  'abort_if', 'url',
+  'abort_if', 'url', 'get_deadline', 'remaining_time', 'check_deadline',
+  'LazyValue', 'lazy', 'stream',
   # variables
   'local', 'current_app', 'request', 'session', 'url_adapter', 'config',
   # external identifiers
@@ -51,6 +54,11 @@ config = LocalProxy(lambda: current_app.config)
 
 _lock = threading.RLock()
 
+GAE_REQUEST_DEADLINE = 60
+GAE_TASK_DEADLINE = 600
+# the shortest deadline a client can ask for with the header
+MIN_HEADER_DEADLINE = 1.0
+
 
 try:
   from google.appengine.ext.ndb import toplevel as toplevel_ndb, \
@@ -92,15 +100,36 @@ class Application(object):
   def __init__(self, config=None, **kwds):
     self.config = self.load_config(config, **kwds)
     self.view_functions = {}
+    self.view_specs = {}
     self.url_map = Map()
     self.url_map.strict_slashes = self.config.get('url_strict_slashes', False)
+    self.url_cache = LRUCache(self.config.get('url_cache_size') or 1024)
+    self.url_templates = {}
     self.request_class = self.config.get('request_class') or Request
     self.response_class = self.config.get('response_class') or Response
     self.error_handlers = {}
+    self.error_templates = self.config.get('error_templates') or {}
+    self.error_responses = {}
+    self.cache_error_responses = self.config.get('cache_error_responses', True)
+    self.cache_error_templates = self.config.get('cache_error_templates', False)
+    self.exception_counters = {}
+    self.exception_log_interval = self.config.get('exception_log_interval', 60)
     self.jinja2_extensions = self.config.get('jinja2_extensions') or []
     self.jinja2_environment_kwargs = self.config.get('jinja2_environment_kwargs') or {}
+    self.template_paths = {}
+    # the names set by init_template_globals, and the Context.version then
+    self.template_globals = frozenset()
+    self.template_globals_version = None
+    self.preloaded_templates = set()
     self.logging_exception = self.config.get('logging_exception') or True
     self.is_first_request = True
+    self.watch_files = self.config.get('watch_files', False)
+    self.watcher = None
+    self.watcher_pid = None
+    self.static_index = None
+    if self.config.get('cache_backend'):
+      from . import cache
+      cache.set_backend(self.make_cache_backend())
   
   def load_config(self, config, **kwds):
     if not config:
@@ -120,6 +149,8 @@ class Application(object):
       view_func=self.send_static_file)
     for endpoint, value in Context.get_routes().iteritems():
       self.add_url_rule(value[0], endpoint=endpoint, **value[1])
+    if self.config.get('url_precompile'):
+      self.precompile_url_templates()
   
   def add_url_rule(self, rules, endpoint, view_func, **options):
     options.setdefault('methods', ('GET', 'POST', 'OPTIONS'))
@@ -131,6 +162,46 @@ class Application(object):
         rule = '/' + rule
       self.url_map.add(Rule(rule, **options))
     self.view_functions[endpoint] = view_func
+    if isinstance(view_func, (tuple, basestring)):
+      self.view_specs[endpoint] = view_func
+    self.url_cache.clear()
+    self.url_templates.pop(endpoint, None)
+  
+  def build_url(self, endpoint, values):
+    """Builds the path for `endpoint`. The results are cached
+    per endpoint, values and script root."""
+    adapter = url_adapter
+    if values:
+      key = (endpoint, tuple(sorted(values.iteritems())),
+        adapter.script_name, adapter.server_name, adapter.subdomain)
+      try:
+        ret = self.url_cache.get(key)
+      except TypeError:
+        key = ret = None
+    else:
+      key = (endpoint, (), adapter.script_name, adapter.server_name,
+        adapter.subdomain)
+      ret = self.url_cache.get(key)
+    if ret is not None:
+      return ret
+    template = self.url_templates.get(endpoint)
+    if template:
+      ret = template(adapter.script_name, values)
+    if ret is None:
+      ret = adapter.build(endpoint, values)
+      if not ret.startswith('/'):
+        ret = '/' + ret
+    if key is not None:
+      self.url_cache.set(key, ret)
+    return ret
+  
+  def precompile_url_templates(self, *endpoints):
+    """Compiles the rules of `endpoints` (all if omitted) to format
+    strings, so building them does not need the url adapter."""
+    for endpoint in (endpoints or self.view_functions.keys()):
+      template = compile_url_template(list(self.url_map.iter_rules(endpoint)))
+      if template:
+        self.url_templates[endpoint] = template
   
   def make_response(self, *args, **kwds):
     if 1 != len(args) or isinstance(args[0], basestring):
@@ -212,7 +283,9 @@ class Application(object):
   def dispatch_request(self):
     try:
       if request.routing_exception:
-        return request.routing_exception
+        if isinstance(request.routing_exception, RequestRedirect):
+          return request.routing_exception
+        return self.handle_exception(request.routing_exception)
       view_func = self.get_view_func(request.url_rule.endpoint)
       response = self.process_view(view_func)
       if response:
@@ -257,19 +330,126 @@ class Application(object):
     code = getattr(e, 'code', 500)
     if 500 <= code <= 599:
       if self.logging_exception:
-        logging.exception(e)
+        self.log_exception(e)
+    key = self.get_error_response_key(e, code)
+    if key is None:
+      return self.make_error_response(e, code)
+    cached = self.error_responses.get(key)
+    if cached is None:
+      response = self.make_response(self.make_error_response(e, code))
+      headers = [(k, v) for k, v in response.headers
+        if k.lower() not in ('set-cookie', 'date')]
+      cached = (response.get_data(), response.status_code, headers)
+      self.error_responses[key] = cached
+      return response
+    return self.response_class(cached[0], status=cached[1], headers=cached[2])
+  
+  def get_error_response_key(self, e, code):
+    """Returns the key to cache the error response for `e`,
+    or None if the response should be made for each error.
+    
+    The responses of the handlers in `error_handlers` are cached only if
+    the handler has a true `cacheable` attribute, since they may depend
+    on the request, redirect or set cookies. The same goes for the
+    `error_templates`, which are cached only with `cache_error_templates`
+    and never for an error with its own description.
+    """
+    if not self.cache_error_responses or code < 400:
+      return None
+    handler = self.error_handlers.get(code)
+    if handler:
+      if getattr(handler, 'cacheable', False):
+        return ('handler', code)
+      return None
+    if code in self.error_templates:
+      if self.cache_error_templates and 'description' not in e.__dict__:
+        return ('template', code, self.error_templates[code])
+      return None
+    if isinstance(e, exceptions.HTTPException) and \
+      'description' not in e.__dict__ and \
+      not getattr(e, 'valid_methods', None):
+      return ('default', e.__class__)
+    if not hasattr(e, 'get_response'):
+      return ('default', exceptions.InternalServerError)
+    return None
+  
+  def make_error_response(self, e, code):
     handler = self.error_handlers.get(code)
     if handler:
       return handler(e)
+    template = self.error_templates.get(code)
+    if template:
+      return self.response_class(self.jinja2_env.get_template(template).render(
+        code=code, description=getattr(e, 'description', None)), status=code)
     if hasattr(e, 'get_response'):
       return e.get_response(request.environ)
     return exceptions.InternalServerError()
   
+  def log_exception(self, e):
+    """Logs the exception, but only once in `exception_log_interval`
+    seconds for the same traceback."""
+    interval = self.exception_log_interval
+    if not interval:
+      logging.exception(e)
+      return
+    signature = get_exception_signature(e, sys.exc_info()[2])
+    now = time.time()
+    with _lock:
+      counter = self.exception_counters.get(signature)
+      if counter is None:
+        if 1000 <= len(self.exception_counters):
+          self.exception_counters.clear()
+        # [total, suppressed since last logging, last logged at]
+        counter = self.exception_counters[signature] = [0, 0, 0.0]
+      counter[0] += 1
+      if now - counter[2] < interval:
+        counter[1] += 1
+        return
+      suppressed = counter[1]
+      counter[1] = 0
+      counter[2] = now
+    if suppressed:
+      logging.exception('%s (%d same errors suppressed, %d in total)' % (
+        e, suppressed, counter[0]))
+    else:
+      logging.exception(e)
+  
   def init_context(self, environ):
     local.current_app = self
     local.request = self.request_class(environ)
+    local.deadline = self.init_deadline(environ)
     self.init_url_adapter(environ)
   
+  def init_deadline(self, environ):
+    """Returns the Deadline of the request after `request_deadline`, the
+    limits of GAE and, only with `trust_deadline_header`, the header sent
+    by a proxy. The header can shorten the deadline but not below
+    MIN_HEADER_DEADLINE."""
+    start = time.time()
+    timeouts = []
+    value = self.config.get('request_deadline')
+    if value:
+      timeouts.append(float(value))
+    if self.config.get('trust_deadline_header'):
+      header = self.config.get('request_deadline_header') or 'X-Request-Deadline'
+      value = request.headers.get(header)
+      if value:
+        try:
+          value = float(value)
+        except ValueError:
+          logging.warn('Invalid %s header: %r' % (header, value))
+        else:
+          if not value >= MIN_HEADER_DEADLINE:
+            value = MIN_HEADER_DEADLINE
+          timeouts.append(value)
+    if environ.get('SERVER_SOFTWARE', '').startswith('Google App Engine'):
+      timeouts.append(GAE_TASK_DEADLINE if request.is_taskqueue
+        else GAE_REQUEST_DEADLINE)
+    if not timeouts:
+      return None
+    margin = self.config.get('request_deadline_margin', 0.05) or 0.0
+    return Deadline(min(timeouts), margin=margin, start=start)
+  
   def init_url_adapter(self, environ):
     local.url_adapter = url_adapter = self.url_map.bind_to_environ(environ)
     try:
@@ -308,11 +488,106 @@ class Application(object):
         if self.is_first_request:
           self.init_routes()
           self.init_template_filters()
+          self.init_template_globals()
         self.is_first_request = False
   
+  def init_watcher(self):
+    """Starts a thread watching the templates, static files and views,
+    so changes are picked up without checking files on each request."""
+    with _lock:
+      if self.watcher_pid == os.getpid():
+        return
+      from .watcher import create_watcher
+      env = self.jinja2_env
+      if env:
+        env.auto_reload = False
+      self.static_index = {}
+      self.watcher = create_watcher(
+        [self.template_path, self.static_path, self.views_path],
+        self.on_file_changed, self.config.get('watch_interval') or 1.0)
+      self.watcher.start()
+      self.watcher_pid = os.getpid()
+  
+  def on_file_changed(self, path):
+    if path is None:
+      self.invalidate_templates()
+      self.static_index = {}
+      self.__dict__.pop('template_graph', None)
+    elif path.startswith(self.template_path + os.sep):
+      name = os.path.relpath(path, self.template_path).replace(os.sep, '/')
+      names = [name]
+      if 'template_graph' in self.__dict__:
+        graph = self.template_graph
+        graph.update(name)
+        names.extend(graph.dependents(name))
+      for name in names:
+        self.invalidate_templates(name)
+    elif path.startswith(self.static_path + os.sep):
+      self.static_index.pop(path, None)
+    elif path.startswith(self.views_path + os.sep) and path.endswith('.py'):
+      self.reload_views(path)
+  
+  def invalidate_templates(self, name=None):
+    env = self.jinja2_env
+    if not env:
+      return
+    invalidate = getattr(env.loader, 'invalidate', None)
+    if name is None:
+      self.preloaded_templates.clear()
+      if invalidate:
+        invalidate()
+    else:
+      for key in (name, '/' + name):
+        self.preloaded_templates.discard(key)
+        if invalidate:
+          invalidate(key)
+    if env.cache is not None:
+      env.cache.clear()
+  
+  @cached_property
+  def template_graph(self):
+    from .jinja2deps import TemplateGraph
+    return TemplateGraph(self.jinja2_env, self.template_path)
+  
+  def preload_templates(self, *names):
+    """Loads the templates and all the templates they extend, include or
+    import, so the first render does not compile them one by one.
+    Only the templates reached from `names` are parsed. All the templates
+    are loaded if no names are given, as warmup does."""
+    graph = self.template_graph
+    if not names:
+      graph.build()
+      names = ['/' + name for name in graph]
+    from jinja2 import TemplateError
+    for name in names:
+      if name not in self.preloaded_templates:
+        self.preloaded_templates.add(name)
+        try:
+          graph.preload(self.jinja2_env, name)
+        except TemplateError, e:
+          logging.warn('can not preload %s: %s' % (name, e))
+  
+  def reload_views(self, path):
+    modname = os.path.splitext(os.path.relpath(path, self.project_root))[0]
+    modname = modname.replace(os.sep, '.')
+    if modname.endswith('.__init__'):
+      modname = modname[:-9]
+    with _lock:
+      module = sys.modules.get(modname)
+      if module is None:
+        return
+      reload(module)
+      for endpoint, spec in self.view_specs.iteritems():
+        name = 'views.' + (spec if isinstance(spec, basestring) else spec[0])
+        if name.startswith(modname + '.'):
+          self.view_functions[endpoint] = spec
+    logging.info('Reloaded %s' % modname)
+  
   @toplevel
   def do_run(self, environ, start_response):
     self.init_on_first_request()
+    if self.watch_files and self.watcher_pid != os.getpid():
+      self.init_watcher()
     self.init_context(environ)
     try:
       ret = self.process_request()
@@ -336,7 +611,22 @@ class Application(object):
       return get_debugged_application_class()(obj, evalex=True)
     return obj
   
+  def warmup(self):
+    """Initializes the application and imports all the lazy views."""
+    self.init_on_first_request()
+    for endpoint in self.view_functions.keys():
+      self.load_view_func(endpoint)
+    if self.config.get('preload_templates') and self.jinja2_env:
+      self.preload_templates()
+  
   def run(self, host='127.0.0.1', port=5000, **options):
+    server = options.pop('server', None) or self.config.get('server')
+    if 'prefork' == server:
+      from .server import run_prefork
+      return run_prefork(host, port, self, **options)
+    elif 'threaded' == server:
+      from .server import run_threaded
+      return run_threaded(host, port, self, **options)
     from werkzeug import run_simple
     options.setdefault('use_reloader', self.debug)
     options['use_debugger'] = False
@@ -368,7 +658,7 @@ class Application(object):
   
   def init_jinja2_environ(self):
     try:
-      from jinja2 import Environment
+      from .jinja2env import DecodingEnvironment
     except ImportError:
       self._jinja2_env = None
       return
@@ -378,14 +668,49 @@ class Application(object):
       default_loader = 'raginei.jinja2loader.FileSystemLoader'
     loader_name = self.config.get('jinja2_loader') or default_loader
     loader_cls = import_string(loader_name)
-    template_dir = self.config.get('template_dir') or 'templates'
+    loader_kwds = {}
+    from .jinja2loader import LoaderMixin
+    if issubclass(loader_cls, LoaderMixin):
+      loader_kwds['cache_size'] = self.config.get('template_cache_size')
+      loader_kwds['check_interval'] = self.config.get('template_check_interval')
     env_dict = {
-      'loader': loader_cls(os.path.join(self.project_root, template_dir)),
+      'loader': loader_cls(self.template_path, **loader_kwds),
       #'undefined': NullUndefined,
       'extensions': list(self.iter_jinja2_extensions()),
+      'finalize': finalize_template_value,
+      'bytecode_cache': self.make_bytecode_cache(),
       }
     env_dict.update(self.jinja2_environment_kwargs)
-    self._jinja2_env = Environment(**env_dict)
+    self._jinja2_env = DecodingEnvironment(**env_dict)
+  
+  def make_bytecode_cache(self):
+    name = self.config.get('jinja2_bytecode_cache')
+    if not name:
+      return None
+    from . import jinja2bccache
+    if name == 'filesystem':
+      return jinja2bccache.FileSystemBytecodeCache(
+        self.config.get('jinja2_bytecode_cache_dir'))
+    elif name == 'memcache':
+      return jinja2bccache.MemcacheBytecodeCache(
+        self.config.get('jinja2_bytecode_cache_expiry') or 0)
+    return import_string(name)()
+  
+  def make_cache_backend(self):
+    """Returns the backend of raginei.cache named by the `cache_backend`
+    config: memcache, local, file, shared or an import name. The
+    `cache_backend_options` config is passed to it."""
+    backend = self.config.get('cache_backend')
+    if not isinstance(backend, basestring):
+      return backend
+    from . import cachebackend
+    backend_cls = {
+      'memcache': cachebackend.MemcacheBackend,
+      'local': cachebackend.LocalBackend,
+      'file': cachebackend.FileBackend,
+      'shared': cachebackend.SharedMemoryBackend,
+      }.get(backend) or import_string(backend)
+    return backend_cls(**(self.config.get('cache_backend_options') or {}))
   
   @cached_property
   def debug(self):
@@ -405,6 +730,19 @@ class Application(object):
       return os.path.dirname(parent)
     return parent
   
+  @cached_property
+  def template_path(self):
+    template_dir = self.config.get('template_dir') or 'templates'
+    return os.path.join(self.project_root, template_dir)
+  
+  @cached_property
+  def static_path(self):
+    return os.path.join(self.project_root, 'static')
+  
+  @cached_property
+  def views_path(self):
+    return os.path.join(self.project_root, 'views')
+  
   @cached_property
   def static_dir(self):
     path = self.config.get('static_dir') or '/static/'
@@ -420,6 +758,23 @@ class Application(object):
       for name, f in Context.get_template_filters().iteritems():
         env.filters[name] = f
   
+  def init_template_globals(self):
+    """Stores the values that are the same for every request
+    into the globals of the jinja2 environment. get_template calls it
+    again when a template function has been registered since."""
+    env = self.jinja2_env
+    if env:
+      with _lock:
+        version = Context.version
+        values = default_template_context_processor(request)
+        values['url'] = url
+        for key in self.template_globals:
+          if key not in values:
+            env.globals.pop(key, None)
+        env.globals.update(values)
+        self.template_globals = frozenset(values)
+        self.template_globals_version = version
+  
   def send_static_file(self, filename, mimetype=None, attachment=None, add_etags=True):
     import mimetypes
     from werkzeug.wsgi import wrap_file
@@ -427,8 +782,10 @@ class Application(object):
     
     abort_if('..' in filename)
     filename = os.path.normpath(filename)
-    filename = os.path.join(self.project_root, 'static', filename)
-    abort_if(not os.path.isfile(filename))
+    filename = os.path.join(self.static_path, filename)
+    st = self.get_static_stat(filename)
+    abort_if(st is None)
+    mtime, size = st
     
     file = open(filename, 'rb')
     data = wrap_file(request.environ, file)
@@ -436,18 +793,19 @@ class Application(object):
     if not mimetype:
       mimetype = mimetypes.guess_type(attachment or filename)[0] or 'application/octet-stream'
     
-    rv = self.make_response(data, mimetype=mimetype, direct_passthrough=True)
+    rv = self.response_class(data, mimetype=mimetype, direct_passthrough=True)
+    rv.content_length = size
     
     if attachment:
       rv.headers.add('Content-Disposition', 'attachment', filename=attachment)
     
     if not self.debug:
       
-      mtime = request.environ.get('CURRENT_VERSION_ID')
-      if not mtime:
-        mtime = os.path.getmtime(filename)
-        if mtime:
-          rv.last_modified = rv.date = int(mtime)
+      version = request.environ.get('CURRENT_VERSION_ID')
+      if version:
+        mtime = version
+      elif mtime:
+        rv.last_modified = rv.date = int(mtime)
       
       rv.cache_control.public = True
       
@@ -458,12 +816,31 @@ class Application(object):
       
       if add_etags:
         rv.set_etag('%s-%s-%s' % (
-          mtime, os.path.getsize(filename), adler32(
+          mtime, size, adler32(
             filename.encode('utf8') if isinstance(filename, unicode) else filename
           ) & 0xffffffff))
       
       rv = rv.make_conditional(request)
     return rv
+  
+  def get_static_stat(self, filename):
+    """Returns (mtime, size) of a static file, or None if it is not
+    a regular file. The results are indexed while the watcher runs."""
+    index = self.static_index
+    if index is not None:
+      st = index.get(filename)
+      if st is not None:
+        return st
+    try:
+      st = os.stat(filename)
+    except OSError:
+      return None
+    if not stat.S_ISREG(st.st_mode):
+      return None
+    st = (st.st_mtime, st.st_size)
+    if index is not None:
+      index[filename] = st
+    return st
 
 
 def to_unicode(s, encoding='utf-8', errors='strict'):
@@ -484,6 +861,17 @@ def to_unicode(s, encoding='utf-8', errors='strict'):
   return s
 
 
+def finalize_template_value(value):
+  """Resolves lazy values, and decodes the byte strings made while
+  rendering, such as the results of functions, when they are printed.
+  The values of the context are decoded by DecodingEnvironment."""
+  if isinstance(value, LazyValue):
+    value = value._get_current_object()
+  if isinstance(value, str):
+    return value.decode('utf-8')
+  return value
+
+
 def route(*rules, **kwds):
   def decorator(f):
     flet = synctasklet(f)
@@ -522,9 +910,51 @@ def default_template_context_processor(request):
   return values
 
 
-def context_processor(f):
-  Context.add_template_context_processor(f)
-  return f
+class LazyValue(LocalProxy):
+  """Proxies the result of `func`, which is called when the value is
+  used for the first time. If the result is a future, its get_result()
+  is used instead."""
+  
+  def __init__(self, func):
+    result = []
+    def resolve():
+      if not result:
+        value = func()
+        if hasattr(value, 'get_result'):
+          value = value.get_result()
+        result.append(value)
+      return result[0]
+    LocalProxy.__init__(self, resolve)
+
+
+def lazy(func, *args, **kwds):
+  """Returns a template value computed by `func(*args, **kwds)` only if
+  the template uses it. `func` can also be a future."""
+  if hasattr(func, 'get_result'):
+    return LazyValue(func.get_result)
+  return LazyValue(lambda: func(*args, **kwds))
+
+
+def lazy_context(processor, keys):
+  ret = LazyValue(lambda: processor(request) or {})
+  return dict((key, LazyValue(lambda key=key: ret.get(key))) for key in keys)
+
+
+def context_processor(f=None, optional=False, keys=None):
+  """Registers a template context processor.
+  Optional processors are skipped when the request deadline is near.
+  A processor declaring the `keys` it returns is called only when
+  a template uses one of them."""
+  def decorator(f):
+    if optional:
+      f.__optional_context__ = True
+    if keys:
+      f.__context_keys__ = tuple(keys)
+    Context.add_template_context_processor(f)
+    return f
+  if f is None:
+    return decorator
+  return decorator(f)
 
 
 def request_middleware(f):
@@ -553,17 +983,47 @@ def exception_middleware(f):
 
 
 @measure_time
-def fetch(template, **values):
-  ret = default_template_context_processor(request)
-  if ret:
-    values.update(ret)
+def get_template(template, values):
+  """Returns the template and adds the values of the context processors
+  to `values`.
+  
+  As when they were passed with the values, the template globals
+  override the values of the view, the context processors override the
+  globals, and url overrides all.
+  """
+  app = current_app
+  if app.template_globals_version != Context.version:
+    app.init_template_globals()
+  names = app.template_globals
+  for key in [key for key in values if key in names]:
+    del values[key]
+  deadline = get_deadline()
+  degraded = deadline is not None and deadline.degraded
   for processor in Context.get_template_context_processors():
+    if degraded and getattr(processor, '__optional_context__', False):
+      continue
+    keys = getattr(processor, '__context_keys__', None)
+    if keys:
+      values.update(lazy_context(processor, keys))
+      continue
     ret = processor(request)
     if ret:
       values.update(ret)
-  values['url'] = url
-  return current_app.jinja2_env.get_template(
-    get_template_path(template)).render(to_unicode(values))
+  values.pop('url', None)
+  path = get_template_path(template)
+  if path not in app.preloaded_templates and \
+    app.config.get('preload_templates'):
+    app.preload_templates(path)
+  return app.jinja2_env.get_template(path)
+
+
+def fetch(template, **values):
+  return get_template(template, values).render(values)
+
+
+def stream(template, **values):
+  """Returns a generator of the rendered template."""
+  return get_template(template, values).generate(values)
 
 
 def render(template, **values):
@@ -636,7 +1096,12 @@ def get_template_path(template):
   foo/bar/baz => /welcome/foo/bar/baz.html
   ..foo => /foo.html
   """
-  paths = local.endpoint.split('.')
+  key = (local.endpoint, template)
+  try:
+    return current_app.template_paths[key]
+  except KeyError:
+    pass
+  paths = key[0].split('.')
   if template:
     if template.startswith('..'):
       template = '%s/%s' % ('/'.join(paths[1:-2]), template[2:])
@@ -646,6 +1111,7 @@ def get_template_path(template):
     template = '/'.join(paths[1:])
   if '.' not in template:
     template = template + '.html'
+  current_app.template_paths[key] = template
   return template
 
 
@@ -666,15 +1132,56 @@ def url(endpoint, **values):
   else:
     if endpoint.startswith('.'):
       endpoint = endpoint[1:]
-    ret = url_adapter.build(endpoint, values, force_external=external)
-    if not ret.startswith('/'):
-      ret = '/' + ret
+    ret = current_app.build_url(endpoint, values)
   if external:
     scheme = 'https' if request.is_secure else 'http'
     ret = '%s://%s%s' % (scheme, get_host(request.environ), ret)
   return ret
 
 
+def get_exception_signature(e, tb):
+  frames = []
+  while tb is not None:
+    frames.append((tb.tb_frame.f_code.co_filename, tb.tb_lineno))
+    tb = tb.tb_next
+  return (e.__class__, tuple(frames))
+
+
+def compile_url_template(rules):
+  """Returns a function building the path of the only rule in `rules`,
+  or None if the rule can not be built by string formatting."""
+  if 1 != len(rules):
+    return None
+  rule = rules[0]
+  if rule.defaults or rule.redirect_to or rule.subdomain or rule.host:
+    return None
+  charset = rule.map.charset
+  parts = []
+  converters = []
+  for is_dynamic, data in rule._trace:
+    if is_dynamic:
+      parts.append('%s')
+      converters.append((data, rule._converters[data]))
+    else:
+      parts.append(url_quote(data, charset, safe='/:|+').replace('%', '%%'))
+  fmt = ''.join(parts).split('|', 1)[1]
+  arguments = frozenset(rule.arguments)
+  def build(script_name, values):
+    if len(values) != len(arguments) or arguments.difference(values):
+      return None
+    args = []
+    try:
+      for name, converter in converters:
+        value = values[name]
+        if value is None:
+          return None
+        args.append(converter.to_url(value))
+    except ValidationError:
+      return None
+    return str(script_name.rstrip('/') + fmt % tuple(args))
+  return build
+
+
 def register_future(future):
   try:
     local.futures
@@ -685,11 +1192,37 @@ def register_future(future):
 
 def wait_futures():
   try:
-    for f in local.futures:
-      f.wait()
-    local.futures = []
+    futures = local.futures
   except AttributeError:
-    pass
+    return
+  deadline = get_deadline()
+  if deadline is not None and deadline.expired:
+    # the cache writes are still waited on, not to lose them
+    pending = len([f for f in futures if not f.done()])
+    if pending:
+      logging.warn('wait_futures: deadline exceeded, waiting on %d futures'
+        % pending)
+  for f in futures:
+    f.wait()
+  local.futures = []
+
+
+def get_deadline():
+  return getattr(local, 'deadline', None)
+
+
+def remaining_time(default=None):
+  """Returns the seconds left until the request deadline."""
+  deadline = get_deadline()
+  if deadline is None:
+    return default
+  return deadline.remaining()
+
+
+def check_deadline():
+  deadline = get_deadline()
+  if deadline is not None:
+    deadline.check()
 
 
 #load default modeles to register toplevel context
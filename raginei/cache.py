@@ -7,84 +7,781 @@ raginei.cache
 :license: Apache License 2.0, see LICENSE for more details.
 """
 
+from __future__ import with_statement
+
+import math
+import time
+import zlib
+import random
+import marshal
 import logging
 import hashlib
-import base64
+import threading
+import cPickle as pickle
 
 try:
-  from google.appengine.api import memcache
   from google.appengine.ext.ndb import Future, Return
 except ImportError:
   Future = None
-  try:
-    import pylibmc as memcache
-  except ImportError:
+
+from . import util
+
+
+# changed when the format of the keys changes
+KEY_VERSION = 2
+
+# arguments whose repr is used as is
+_FAST_TYPES = frozenset([int, str, bool, float, type(None)])
+
+
+def _normalize(v):
+  """Makes equal values have the same repr: u'a' and 'a', 1 and 1L,
+  lists and tuples, sets and dicts in any order."""
+  if type(v) in _FAST_TYPES:
+    return v
+  elif isinstance(v, unicode):
+    return v.encode('utf-8')
+  elif isinstance(v, (int, long)):
+    return int(v)
+  elif isinstance(v, (list, tuple)):
+    return tuple([_normalize(x) for x in v])
+  elif isinstance(v, (set, frozenset)):
+    return tuple(sorted([_normalize(x) for x in v]))
+  elif isinstance(v, dict):
+    return tuple(sorted([(_normalize(k), _normalize(x))
+      for k, x in v.iteritems()]))
+  return str(v)
+
+
+def key_prefix(func, namespace=None, version=None, envelope=False):
+  """Returns the part of the keys of `func` fixed at decoration.
+  The values stored in envelopes get other keys than the raw values,
+  not to read one as the other when `stale` or `beta` is changed."""
+  if isinstance(namespace, unicode):
+    namespace = namespace.encode('utf-8')
+  prefix = '%d:%s:%s:%s:' % (KEY_VERSION, namespace or '',
+    util.funcname(func), version or '')
+  if envelope:
+    prefix += 'e:'
+  return prefix
+
+
+def make_key(prefix, args, kwds):
+  if kwds:
+    raw = repr((_normalize(args), _normalize(kwds)))
+  else:
+    for arg in args:
+      if type(arg) not in _FAST_TYPES:
+        raw = repr(_normalize(args))
+        break
+    else:
+      raw = repr(args)
+  return hashlib.md5(prefix + raw).hexdigest()
+
+
+def cache_key(func, *args, **kwds):
+  memo = get_memoizer(func)
+  if memo is not None:
+    return memo.key(args, kwds)
+  return make_key(key_prefix(func), args, kwds)
+
+
+_backend = None
+_backend_ready = False
+
+
+def set_backend(backend):
+  """Sets the CacheBackend of raginei.cache. None disables the cache."""
+  global _backend, _backend_ready
+  _backend = backend
+  _backend_ready = True
+
+
+def get_backend():
+  """Returns the CacheBackend set by set_backend, or the memcache if no
+  backend was set. Application sets the one of the `cache_backend` config."""
+  global _backend, _backend_ready
+  if not _backend_ready:
+    from .cachebackend import MemcacheBackend
     try:
-      import memcache
+      _backend = MemcacheBackend()
     except ImportError:
-      memcache = None
+      logging.warn('raginei.cache: no memcache client is available,'
+        ' set the cache_backend config to cache the values')
+      _backend = None
+    _backend_ready = True
+  return _backend
 
 
-from . import util
+def backend_stats():
+  """Returns the metrics of the backend, such as the waits for the pooled
+  memcache clients and the errors."""
+  backend = get_backend()
+  if backend is None:
+    return {}
+  return backend.stats()
 
 
-def cache_key(func, *args, **kwds):
-  key = 'raginei.cache.cache_key:%s-%s-%s' % (
-    util.funcname(func), util.to_str(args), util.to_str(kwds))
-  if isinstance(key, unicode):
-    key = key.encode('utf-8')
-  return base64.b32encode(hashlib.sha1(key).digest())
+def cache_get(key):
+  backend = get_backend()
+  if backend is not None:
+    return backend.get(key)
+
+
+def cache_set(key, value, expiry=0):
+  backend = get_backend()
+  if backend is not None:
+    backend.set(key, value, expiry)
+
+
+def cache_get_multi(keys):
+  backend = get_backend()
+  if backend is not None and keys:
+    return backend.get_multi(keys)
+  return {}
+
+
+def cache_set_multi(mapping, expiry=0):
+  backend = get_backend()
+  if backend is not None and mapping:
+    backend.set_multi(mapping, expiry)
+
+
+def cache_add(key, value, expiry=0):
+  backend = get_backend()
+  if backend is not None:
+    return backend.add(key, value, expiry)
+  return False
+
+
+def cache_incr(key, delta=1):
+  backend = get_backend()
+  if backend is not None:
+    return backend.incr(key, delta)
+
+
+def cache_delete(key):
+  backend = get_backend()
+  if backend is not None:
+    backend.delete(key)
+
+
+GENERATION_PREFIX = 'raginei.cache.generation:'
+
+# the generations used when there is no backend
+_generations = {}
+
+
+def _request_generations():
+  """Returns the generations read in the current request."""
+  from .app import local
+  if getattr(local, 'request', None) is None:
+    return None
+  gens = getattr(local, 'cache_generations', None)
+  if gens is None:
+    gens = local.cache_generations = {}
+  return gens
+
+
+def _new_generation():
+  # not to reuse the old keys if the counter was evicted
+  return int(time.time() * 1000)
+
+
+def get_generations(tags):
+  """Returns {tag: generation}. The generations are read with one call
+  and kept until the end of the request."""
+  gens = _request_generations()
+  result = {}
+  missing = []
+  for tag in tags:
+    if gens is not None and tag in gens:
+      result[tag] = gens[tag]
+    else:
+      missing.append(tag)
+  if not missing:
+    return result
+  if get_backend() is None:
+    for tag in missing:
+      result[tag] = _generations.setdefault(tag, _new_generation())
+  else:
+    found = cache_get_multi([GENERATION_PREFIX + tag for tag in missing])
+    for tag in missing:
+      key = GENERATION_PREFIX + tag
+      gen = found.get(key)
+      if gen is None:
+        gen = _new_generation()
+        if not cache_add(key, gen):
+          gen = cache_get(key) or gen
+      result[tag] = gen
+  if gens is not None:
+    gens.update(result)
+  return result
+
+
+def invalidate_tags(*tags):
+  """Drops all the values memoized with the tags or namespaces by
+  changing their generations."""
+  gens = _request_generations()
+  for tag in tags:
+    if get_backend() is None:
+      gen = _generations[tag] = _generations.get(tag, 0) + 1
+    else:
+      key = GENERATION_PREFIX + tag
+      gen = cache_incr(key)
+      if gen is None:
+        gen = _new_generation()
+        cache_set(key, gen)
+    if gens is not None:
+      gens[tag] = gen
+
+
+class Serializer(object):
+  """Turns the values into strings for the cache.
+  
+  Plain values are marshalled and the others are pickled with the
+  highest protocol. Strings longer than `compress_threshold` bytes are
+  compressed with zlib. Memoizer splits the strings longer than
+  `chunk_size` into several items.
+  """
+  
+  def __init__(self, compress_threshold=1024, compress_level=6,
+               chunk_size=1000000, use_marshal=True):
+    self.compress_threshold = compress_threshold
+    self.compress_level = compress_level
+    self.chunk_size = chunk_size
+    self.use_marshal = use_marshal
+  
+  def dumps(self, value):
+    if self.use_marshal and _is_marshallable(value):
+      data = 'M' + marshal.dumps(value)
+    else:
+      data = 'P' + pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if self.compress_threshold is not None and \
+      self.compress_threshold < len(data):
+      compressed = zlib.compress(buffer(data, 1), self.compress_level)
+      if len(compressed) < len(data) - 1:
+        # lower case for the compressed data
+        data = data[0].lower() + compressed
+    return data
+  
+  def loads(self, data):
+    flag = data[:1]
+    if flag in ('m', 'p'):
+      data = flag.upper() + zlib.decompress(buffer(data, 1))
+      flag = data[0]
+    if 'M' == flag:
+      return marshal.loads(buffer(data, 1))
+    elif 'P' == flag:
+      return pickle.loads(data[1:])
+    raise ValueError('unknown format: %r' % flag)
 
 
-def memoize(expiry=300):
-  """A decorator to memoize functions in the memcache."""
-  debug = util.is_debug()
+default_serializer = Serializer()
+
+
+_MARSHAL_ATOMS = frozenset([int, long, float, bool, type(None), str, unicode])
+_MARSHAL_CONTAINERS = frozenset([tuple, list, set, frozenset])
+
+
+def _is_marshallable(value):
+  """True if `value` is made of the exact types marshal keeps. marshal
+  writes subclasses of str and unicode, such as Markup, and the buffers
+  as plain strings."""
+  t = type(value)
+  if t in _MARSHAL_ATOMS:
+    return True
+  elif t in _MARSHAL_CONTAINERS:
+    for x in value:
+      if not _is_marshallable(x):
+        return False
+    return True
+  elif t is dict:
+    for k, x in value.iteritems():
+      if not _is_marshallable(k) or not _is_marshallable(x):
+        return False
+    return True
+  return False
+
+
+# {function name: Memoizer}
+_memoizers = {}
+_invalidation_hooks = []
+
+
+def get_memoizer(func):
+  """Returns the Memoizer of the memoized function or its wrapper."""
+  return getattr(func, 'memoizer', None) or \
+    _memoizers.get(util.funcname(func))
+
+
+def add_invalidation_hook(hook):
+  """Registers `hook(key)`, called when memoize_delete deletes `key`.
+  It can tell the other processes to call local_cache_delete(key)."""
+  _invalidation_hooks.append(hook)
+
+
+def local_cache_delete(key):
+  """Deletes `key` from the local caches of this process."""
+  for memo in _memoizers.values():
+    if memo.local is not None:
+      memo.local.delete(key)
+
+
+class Memoizer(object):
+  """The caches and the stats of a memoized function.
+  
+  Options:
+    `namespace`, `version`: parts of the keys, changing the version
+      drops all the values of the function. The values of a namespace
+      are dropped by invalidate_tags(namespace).
+    `tags`: a list of tags, or a function taking the same arguments and
+      returning them. invalidate_tags(tag) drops the values with the tag.
+    `serializer`: a Serializer for the values, default_serializer if
+      None. False stores the values as they are.
+    `local_expiry`: keep the values in an in-process LRU of `local_size`
+      items for that many seconds, at most `expiry`.
+    `lock`: let only one caller recompute a missing value. The others
+      wait up to `lock_timeout` seconds for it. The lease is taken with
+      memcache add, and concurrent callers in the process share one call.
+    `stale`: keep the values that many seconds after `expiry`, and serve
+      them while one caller recomputes the value. Implies `lock`.
+    `beta`: recompute the values before they expire, with a probability
+      growing as the expiry nears and with the time the function took.
+      1.0 is a good value; larger values recompute earlier.
+  """
+  
+  lock_interval = 0.05
+  
+  def __init__(self, func, expiry=300, local_expiry=None, local_size=1000,
+               lock=False, lock_timeout=10, stale=0, beta=0,
+               namespace=None, version=None, tags=None, serializer=None):
+    self.func = func
+    self.expiry = expiry
+    # values are stored as (value, fresh until, seconds to compute)
+    self.envelope = bool(stale or beta)
+    self.prefix = key_prefix(func, namespace, version, self.envelope)
+    self.static_tags = [namespace] if namespace else []
+    if callable(tags):
+      self.tags = tags
+    else:
+      self.static_tags.extend(tags or ())
+      self.tags = None
+    _memoizers[util.funcname(func)] = self
+    self.enabled = bool(expiry) and not util.is_debug()
+    if expiry and local_expiry:
+      self.local_expiry = min(local_expiry, expiry)
+      self.local = util.LRUCache(local_size)
+    else:
+      self.local_expiry = None
+      self.local = None
+    self.lock = lock or bool(stale)
+    self.lock_timeout = lock_timeout
+    self.stale = stale
+    self.beta = beta
+    if serializer is None:
+      serializer = default_serializer
+    self.serializer = serializer or None
+    self.hits = self.misses = self.stales = 0
+    self.writes = self.bytes = self.compressed = self.chunked = 0
+    self._flights = {}
+    self._flights_lock = threading.Lock()
+    self._tasklet_flights = threading.local()
+  
+  def get_tags(self, args, kwds):
+    if self.tags is None:
+      return self.static_tags
+    return self.static_tags + list(self.tags(*args, **kwds))
+  
+  def key(self, args, kwds):
+    if not self.static_tags and self.tags is None:
+      return make_key(self.prefix, args, kwds)
+    return self.key_multi([(args, kwds)])[0]
+  
+  def key_multi(self, calls):
+    """Returns the keys of [(args, kwds)], reading the generations of
+    all their tags at once."""
+    if not self.static_tags and self.tags is None:
+      return [make_key(self.prefix, args, kwds) for args, kwds in calls]
+    tags = [self.get_tags(args, kwds) for args, kwds in calls]
+    gens = get_generations(set(tag for t in tags for tag in t))
+    keys = []
+    for (args, kwds), t in zip(calls, tags):
+      prefix = '%s%s:' % (self.prefix, ','.join([str(gens[tag]) for tag in t]))
+      keys.append(make_key(prefix, args, kwds))
+    return keys
+  
+  def get(self, key):
+    """Returns (value, fresh). A stale value is returned with False."""
+    if self.local is not None:
+      data = self.local.get(key)
+      if data is not None:
+        return data, True
+    data = self.read(key)
+    if data is None:
+      self.misses += 1
+      return None, False
+    self.hits += 1
+    if self.envelope:
+      data, fresh_until, delta = data
+      now = time.time()
+      if self.beta and delta:
+        now -= delta * self.beta * math.log(random.random())
+      if fresh_until <= now:
+        self.stales += 1
+        return data, False
+    if self.local is not None:
+      self.local.set(key, data, self.local_expiry)
+    return data, True
+  
+  def peek(self, key):
+    data = self.read(key)
+    if data is not None and self.envelope:
+      data = data[0]
+    return data
+  
+  def get_multi(self, keys):
+    result = {}
+    if self.local is not None:
+      for key in keys:
+        data = self.local.get(key)
+        if data is not None:
+          result[key] = data
+      keys = [key for key in keys if key not in result]
+    if keys:
+      found = self.loads(cache_get_multi(keys))
+      self.hits += len(found)
+      self.misses += len(keys) - len(found)
+      if self.local is not None:
+        for key, data in found.iteritems():
+          self.local.set(key, data, self.local_expiry)
+      result.update(found)
+    return result
+  
+  def set(self, key, data, delta=0):
+    if self.local is not None:
+      self.local.set(key, data, self.local_expiry)
+    if self.envelope:
+      self.write(self.dumps(key, (data, time.time() + self.expiry, delta)),
+        self.expiry + self.stale)
+    else:
+      self.write(self.dumps(key, data), self.expiry)
+  
+  def read(self, key):
+    data = cache_get(key)
+    if data is None or self.serializer is None:
+      return data
+    return self.loads({key: data}).get(key)
+  
+  def write(self, mapping, expiry):
+    if 1 == len(mapping):
+      key, data = mapping.popitem()
+      cache_set(key, data, expiry)
+    else:
+      cache_set_multi(mapping, expiry)
+  
+  def dumps(self, key, value):
+    """Returns {key: string} to store `value` under `key`."""
+    if self.serializer is None:
+      return {key: value}
+    data = self.serializer.dumps(value)
+    self.writes += 1
+    self.bytes += len(data)
+    if data[0] in 'mp':
+      self.compressed += 1
+    size = self.serializer.chunk_size
+    if not size or len(data) <= size:
+      return {key: data}
+    self.chunked += 1
+    # the chunks of a value written at the same time do not get mixed
+    token = '%08x' % random.getrandbits(32)
+    count = (len(data) + size - 1) // size
+    mapping = {key: 'C%s:%d' % (token, count)}
+    for i in xrange(count):
+      mapping['%s:%s:%d' % (key, token, i)] = data[i * size:(i + 1) * size]
+    return mapping
+  
+  def loads(self, found):
+    """Decodes {key: string} read from the cache, with the chunks."""
+    if self.serializer is None:
+      return found
+    result = {}
+    chunked = {}
+    for key, data in found.iteritems():
+      if not isinstance(data, str):
+        result[key] = data
+      elif data.startswith('C'):
+        try:
+          token, count = data[1:].split(':')
+          count = int(count)
+        except ValueError:
+          # a miss, not an error of the request
+          logging.warn('raginei.cache: can not load %s: bad chunk header'
+            % key)
+          continue
+        chunked[key] = ['%s:%s:%d' % (key, token, i)
+          for i in xrange(count)]
+      else:
+        self._loads(result, key, data)
+    if chunked:
+      chunks = cache_get_multi(
+        [chunk for keys in chunked.itervalues() for chunk in keys])
+      for key, keys in chunked.iteritems():
+        if all(chunk in chunks for chunk in keys):
+          self._loads(result, key, ''.join([chunks[chunk] for chunk in keys]))
+    return result
+  
+  def _loads(self, result, key, data):
+    try:
+      result[key] = self.serializer.loads(data)
+    except Exception, e:
+      logging.warn('raginei.cache: can not load %s: %s' % (key, e))
+  
+  def set_multi(self, mapping):
+    if self.local is not None:
+      for key, data in mapping.iteritems():
+        self.local.set(key, data, self.local_expiry)
+    data = {}
+    for key, value in mapping.iteritems():
+      data.update(self.dumps(key, value))
+    cache_set_multi(data, self.expiry)
+  
+  def call(self, key, func):
+    start = time.time()
+    data = func()
+    if self.expiry and data is not None:
+      self.set(key, data, time.time() - start)
+    return data
+  
+  def acquire(self, key):
+    """Takes the lease to recompute `key`."""
+    if get_backend() is None:
+      return True
+    return bool(cache_add(key + ':lock', 1, self.lock_timeout))
+  
+  def release(self, key):
+    cache_delete(key + ':lock')
+  
+  def wait_timeout(self):
+    from .app import remaining_time
+    return min(self.lock_timeout, remaining_time(self.lock_timeout))
+  
+  def refresh(self, key, stale, func):
+    if self.acquire(key):
+      try:
+        return self.call(key, func)
+      finally:
+        self.release(key)
+    if stale is not None:
+      return stale
+    # another process is computing the value
+    limit = time.time() + self.wait_timeout()
+    while time.time() < limit:
+      time.sleep(self.lock_interval)
+      data = self.peek(key)
+      if data is not None:
+        return data
+    return self.call(key, func)
+  
+  def singleflight(self, key, func):
+    """Runs `func` once for concurrent callers in the process."""
+    with self._flights_lock:
+      flight = self._flights.get(key)
+      leader = flight is None
+      if leader:
+        flight = self._flights[key] = [threading.Event(), None]
+    if not leader:
+      flight[0].wait(self.wait_timeout())
+      if flight[1] is not None:
+        return flight[1]
+      return func()
+    try:
+      flight[1] = func()
+      return flight[1]
+    finally:
+      with self._flights_lock:
+        self._flights.pop(key, None)
+      flight[0].set()
+  
+  def tasklet_flights(self):
+    """Returns {key: future} of the refreshes running in this thread."""
+    flights = getattr(self._tasklet_flights, 'flights', None)
+    if flights is None:
+      flights = self._tasklet_flights.flights = {}
+    return flights
+  
+  def stats(self):
+    stats = dict(hits=self.hits, misses=self.misses, stales=self.stales,
+      writes=self.writes, bytes=self.bytes, compressed=self.compressed,
+      chunked=self.chunked)
+    if self.local is not None:
+      for k, v in self.local.stats().iteritems():
+        stats['local_' + k] = v
+    return stats
+
+
+def memoize(expiry=300, **options):
+  """A decorator to memoize functions in the memcache.
+  See Memoizer for the options."""
   def _decorator(func):
+    memo = Memoizer(func, expiry, **options)
     @util.wraps(func)
     def _wrapper(*args, **kwds):
       force = kwds.pop('_force', False)
-      key = cache_key(func, *args, **kwds)
-      data = None
-      if not debug and not force and expiry and memcache:
-        data = memcache.get(key)
-      if data is None:
+      key = memo.key(args, kwds)
+      def call():
         data = func(*args, **kwds)
         if Future and isinstance(data, Future):
           data = data.get_result()
-        if expiry and memcache:
-          memcache.set(key, data, expiry)
-      else:
-        logging.debug('memcache: use cache of %s' % key)
-      return data
+        return data
+      if memo.enabled and not force:
+        data, fresh = memo.get(key)
+        if fresh:
+          logging.debug('memcache: use cache of %s' % key)
+          return data
+        if memo.lock:
+          return memo.singleflight(key, lambda: memo.refresh(key, data, call))
+      return memo.call(key, call)
+    _wrapper.memoizer = memo
+    _wrapper.cache_stats = memo.stats
     return _wrapper
   return _decorator
 
 
-def memoize_tasklet(expiry=300):
-  """A decorator to memoize functions in the memcache."""
+def memoize_tasklet(expiry=300, **options):
+  """A decorator to memoize functions in the memcache.
+  See Memoizer for the options."""
   from .app import tasklet
-  debug = util.is_debug()
   def _decorator(func):
+    memo = Memoizer(func, expiry, **options)
+    @tasklet
+    def _call(key, args, kwds):
+      start = time.time()
+      data = yield func(*args, **kwds)
+      if expiry and data is not None:
+        memo.set(key, data, time.time() - start)
+      raise Return(data)
+    @tasklet
+    def _refresh(key, stale, args, kwds):
+      if memo.acquire(key):
+        try:
+          data = yield _call(key, args, kwds)
+        finally:
+          memo.release(key)
+        raise Return(data)
+      if stale is not None:
+        raise Return(stale)
+      from google.appengine.ext.ndb.tasklets import sleep
+      limit = time.time() + memo.wait_timeout()
+      while time.time() < limit:
+        yield sleep(memo.lock_interval)
+        data = memo.peek(key)
+        if data is not None:
+          raise Return(data)
+      data = yield _call(key, args, kwds)
+      raise Return(data)
     @util.wraps(func)
     @tasklet
     def _wrapper(*args, **kwds):
       force = kwds.pop('_force', False)
-      key = cache_key(func, *args, **kwds)
-      data = None
-      if not debug and not force and expiry and memcache:
-        data = memcache.get(key)
-      if data is None:
-        data = yield func(*args, **kwds)
-        if expiry and memcache:
-          memcache.set(key, data, expiry)
-      else:
-        logging.debug('memoize_tasklet hit: %s' % key)
+      key = memo.key(args, kwds)
+      if memo.enabled and not force:
+        data, fresh = memo.get(key)
+        if fresh:
+          logging.debug('memoize_tasklet hit: %s' % key)
+          raise Return(data)
+        if memo.lock:
+          flights = memo.tasklet_flights()
+          flight = flights.get(key)
+          if flight is None:
+            flight = flights[key] = _refresh(key, data, args, kwds)
+            flight.add_callback(flights.pop, key, None)
+          data = yield flight
+          raise Return(data)
+      data = yield _call(key, args, kwds)
       raise Return(data)
+    _wrapper.memoizer = memo
+    _wrapper.cache_stats = memo.stats
+    return _wrapper
+  return _decorator
+
+
+def memoize_multi(expiry=300, local_expiry=None, local_size=1000,
+                  namespace=None, version=None, tags=None, serializer=None):
+  """A decorator to memoize functions taking a list of ids and returning
+  a dict of {id: value}. Each value is cached with the key memoize would
+  use for func(id, ...). The cached values are fetched at once and the
+  function is called only with the missing ids."""
+  def _decorator(func):
+    memo = Memoizer(func, expiry, local_expiry, local_size,
+      namespace=namespace, version=version, tags=tags, serializer=serializer)
+    @util.wraps(func)
+    def _wrapper(ids, *args, **kwds):
+      force = kwds.pop('_force', False)
+      keys = dict(zip(memo.key_multi([((i,) + args, kwds) for i in ids]), ids))
+      result = {}
+      if memo.enabled and not force:
+        for key, data in memo.get_multi(keys.keys()).iteritems():
+          result[keys[key]] = data
+      missing = [i for i in ids if i not in result]
+      if missing:
+        data = func(missing, *args, **kwds)
+        if Future and isinstance(data, Future):
+          data = data.get_result()
+        result.update(data)
+        if expiry:
+          memo.set_multi(_multi_mapping(keys, data))
+      return result
+    _wrapper.memoizer = memo
+    _wrapper.cache_stats = memo.stats
     return _wrapper
   return _decorator
 
 
+def memoize_multi_tasklet(expiry=300, local_expiry=None, local_size=1000,
+                          namespace=None, version=None, tags=None,
+                          serializer=None):
+  """The tasklet version of memoize_multi."""
+  from .app import tasklet
+  def _decorator(func):
+    memo = Memoizer(func, expiry, local_expiry, local_size,
+      namespace=namespace, version=version, tags=tags, serializer=serializer)
+    @util.wraps(func)
+    @tasklet
+    def _wrapper(ids, *args, **kwds):
+      force = kwds.pop('_force', False)
+      keys = dict(zip(memo.key_multi([((i,) + args, kwds) for i in ids]), ids))
+      result = {}
+      if memo.enabled and not force:
+        for key, data in memo.get_multi(keys.keys()).iteritems():
+          result[keys[key]] = data
+      missing = [i for i in ids if i not in result]
+      if missing:
+        data = yield func(missing, *args, **kwds)
+        result.update(data)
+        if expiry:
+          memo.set_multi(_multi_mapping(keys, data))
+      raise Return(result)
+    _wrapper.memoizer = memo
+    _wrapper.cache_stats = memo.stats
+    return _wrapper
+  return _decorator
+
+
+def _multi_mapping(keys, data):
+  mapping = {}
+  for key, i in keys.iteritems():
+    value = data.get(i)
+    if value is not None:
+      mapping[key] = value
+  return mapping
+
+
 def memoize_delete(func, *args, **kwds):
-  if memcache:
-    key = cache_key(func, *args, **kwds)
-    memcache.delete(key)
+  memo = get_memoizer(func)
+  key = cache_key(func, *args, **kwds)
+  cache_delete(key)
+  if memo is not None and memo.local is not None:
+    memo.local.delete(key)
+  for hook in _invalidation_hooks:
+    hook(key)
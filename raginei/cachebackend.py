@@ -0,0 +1,666 @@
+# -*- coding: utf-8 -*-
+"""
+raginei.cachebackend
+====================
+
+:copyright: 2011 by najeira <najeira@gmail.com>.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import os
+import stat
+import math
+import time
+import errno
+import mmap
+import types
+import struct
+import logging
+import hashlib
+import tempfile
+import threading
+import cPickle as pickle
+
+from .util import LRUCache, user_temp_dir
+
+__all__ = ['CacheBackend', 'MemcacheBackend', 'LocalBackend', 'FileBackend',
+  'SharedMemoryBackend', 'make_memcache_client', 'ClientPool', 'PoolTimeout']
+
+
+# memcache treats the expiry longer than 30 days as a unix time
+MAX_RELATIVE_EXPIRY = 60 * 60 * 24 * 30
+
+
+def expires_at(expiry):
+  """Returns the time when an item set with `expiry` expires, 0 if never."""
+  if not expiry:
+    return 0
+  if MAX_RELATIVE_EXPIRY < expiry:
+    return expiry
+  return time.time() + expiry
+
+
+class CacheBackend(object):
+  """The interface of the backends of raginei.cache, which follows the
+  memcache clients. Subclasses implement get, set, add, incr and delete;
+  get_multi and set_multi call them for each key by default."""
+  
+  def get(self, key):
+    raise NotImplementedError()
+  
+  def set(self, key, value, expiry=0):
+    raise NotImplementedError()
+  
+  def add(self, key, value, expiry=0):
+    """Sets `value` only if `key` is not in the cache. Returns True if
+    it was set."""
+    raise NotImplementedError()
+  
+  def incr(self, key, delta=1):
+    """Returns the incremented value, or None if `key` is not in the cache."""
+    raise NotImplementedError()
+  
+  def delete(self, key):
+    raise NotImplementedError()
+  
+  def get_multi(self, keys):
+    result = {}
+    for key in keys:
+      value = self.get(key)
+      if value is not None:
+        result[key] = value
+    return result
+  
+  def set_multi(self, mapping, expiry=0):
+    for key, value in mapping.iteritems():
+      self.set(key, value, expiry)
+  
+  def clear(self):
+    raise NotImplementedError()
+  
+  def stats(self):
+    return {}
+
+
+def make_memcache_client(servers=None, connect_timeout=None, timeout=None,
+                         binary=True, no_delay=True):
+  """Returns the memcache of GAE, or a new client of pylibmc or
+  python-memcache connected to `servers`. None if none of them are
+  available.
+  
+  The timeouts are in seconds. python-memcache uses `timeout` for the
+  connections too, and does not support `binary` and `no_delay`.
+  """
+  try:
+    from google.appengine.api import memcache
+    return memcache
+  except ImportError:
+    pass
+  servers = servers or ['127.0.0.1:11211']
+  try:
+    import pylibmc
+  except ImportError:
+    pass
+  else:
+    behaviors = {'tcp_nodelay': bool(no_delay)}
+    if connect_timeout:
+      behaviors['connect_timeout'] = int(connect_timeout * 1000)
+    if timeout:
+      behaviors['receive_timeout'] = int(timeout * 1000000)
+      behaviors['send_timeout'] = int(timeout * 1000000)
+    return pylibmc.Client(servers, binary=bool(binary), behaviors=behaviors)
+  try:
+    import memcache
+  except ImportError:
+    pass
+  else:
+    timeout = timeout or connect_timeout
+    if timeout:
+      return memcache.Client(servers, socket_timeout=timeout)
+    return memcache.Client(servers)
+  return None
+
+
+class PoolTimeout(Exception):
+  pass
+
+
+class ClientPool(object):
+  """A bounded pool of clients which can not be shared by the threads.
+  
+  Up to `size` clients are made by `factory`. When they are all in use,
+  a thread waits for one up to `timeout` seconds. The clients are made
+  again in a forked process, not to share the connections.
+  """
+  
+  def __init__(self, factory, size=8, timeout=None):
+    self.factory = factory
+    self.size = size
+    self.timeout = timeout
+    self.waits = self.timeouts = self.errors = 0
+    self.wait_time = self.max_wait = 0.0
+    self.reset()
+  
+  def reset(self):
+    self.idle = []
+    self.created = 0
+    self.cond = threading.Condition()
+    self.pid = os.getpid()
+  
+  def get(self, timeout=None):
+    """Returns a client, waiting up to `timeout` seconds or the timeout
+    of the pool, whichever is shorter."""
+    if self.pid != os.getpid():
+      self.reset()
+    if timeout is None or (self.timeout is not None and self.timeout < timeout):
+      timeout = self.timeout
+    with self.cond:
+      if not self.idle and self.size <= self.created:
+        self.wait(timeout)
+      if self.idle:
+        return self.idle.pop()
+      self.created += 1
+    try:
+      return self.factory()
+    except:
+      self.errors += 1
+      self.discard(None)
+      raise
+  
+  def wait(self, timeout):
+    start = time.time()
+    try:
+      while not self.idle and self.size <= self.created:
+        remaining = None
+        if timeout is not None:
+          remaining = start + timeout - time.time()
+          if remaining <= 0:
+            self.timeouts += 1
+            raise PoolTimeout('no memcache client in %.3f seconds' % (
+              timeout))
+        self.cond.wait(remaining)
+    finally:
+      waited = time.time() - start
+      self.waits += 1
+      self.wait_time += waited
+      self.max_wait = max(self.max_wait, waited)
+  
+  def put(self, client):
+    with self.cond:
+      self.idle.append(client)
+      self.cond.notify()
+  
+  def discard(self, client):
+    """Drops `client`, which failed, so that a new one is made."""
+    with self.cond:
+      self.created -= 1
+      self.cond.notify()
+  
+  def stats(self):
+    return dict(size=self.size, created=self.created, idle=len(self.idle),
+      waits=self.waits, wait_time=self.wait_time, max_wait=self.max_wait,
+      timeouts=self.timeouts, errors=self.errors)
+
+
+class MemcacheBackend(CacheBackend):
+  """Uses the memcache of GAE, `client`, or a ClientPool of the clients
+  of pylibmc or python-memcache. The other arguments are passed to
+  make_memcache_client for the pool.
+  
+  The errors of the clients are logged and counted, and treated as
+  misses. In a request with a deadline, the calls do not wait for a
+  client of the pool longer than the time left, and the reads of the
+  memcache of GAE are given the time left as the RPC deadline.
+  """
+  
+  def __init__(self, client=None, pool=None, pool_size=8, pool_timeout=None,
+               **options):
+    if client is None and pool is None:
+      client = make_memcache_client(**options)
+      if client is None:
+        raise ImportError('no memcache client is available')
+      if not isinstance(client, types.ModuleType):
+        # a client is not thread-safe
+        pool = ClientPool(lambda: make_memcache_client(**options),
+          pool_size, pool_timeout)
+        client = None
+    self.client = client
+    self.pool = pool
+    self.errors = 0
+  
+  def call(self, method, default, *args):
+    if self.pool is None:
+      client = self.client
+    else:
+      try:
+        client = self.pool.get(_remaining_time())
+      except PoolTimeout, e:
+        logging.warn('raginei.cachebackend: %s' % e)
+        return default
+    try:
+      result = getattr(client, method)(*args)
+    except Exception, e:
+      if method == 'incr' and type(e).__name__ == 'NotFound':
+        # pylibmc raises NotFound for a missing key
+        result = default
+      else:
+        self.errors += 1
+        logging.warn('raginei.cachebackend: memcache %s failed: %r' % (
+          method, e))
+        if self.pool is not None:
+          self.pool.discard(client)
+        return default
+    if self.pool is not None:
+      self.pool.put(client)
+    return result
+  
+  def get(self, key):
+    if self.pool is None and hasattr(self.client, 'create_rpc'):
+      return self.get_multi([key]).get(key)
+    return self.call('get', None, key)
+  
+  def set(self, key, value, expiry=0):
+    return self.call('set', False, key, value, _seconds(expiry))
+  
+  def add(self, key, value, expiry=0):
+    return bool(self.call('add', False, key, value, _seconds(expiry)))
+  
+  def incr(self, key, delta=1):
+    return self.call('incr', None, key, delta)
+  
+  def delete(self, key):
+    return self.call('delete', False, key)
+  
+  def get_multi(self, keys):
+    timeout = _remaining_time()
+    if timeout is not None and self.pool is None and \
+      hasattr(self.client, 'create_rpc'):
+      # the memcache of GAE takes a deadline for each call
+      rpc = self.client.create_rpc(deadline=max(timeout, 0.001))
+      try:
+        return self.client.Client().get_multi_async(keys, rpc=rpc).get_result()
+      except Exception, e:
+        self.errors += 1
+        logging.warn('raginei.cachebackend: memcache get_multi failed: %r' % e)
+        return {}
+    return self.call('get_multi', {}, keys)
+  
+  def set_multi(self, mapping, expiry=0):
+    return self.call('set_multi', list(mapping), mapping, _seconds(expiry))
+  
+  def clear(self):
+    self.call('flush_all', None)
+  
+  def stats(self):
+    stats = dict(errors=self.errors)
+    if self.pool is not None:
+      stats.update(('pool_%s' % k, v) for k, v in self.pool.stats().iteritems())
+    return stats
+
+
+def _remaining_time():
+  """Returns the seconds left until the deadline of the request, or None."""
+  from .app import remaining_time
+  return remaining_time()
+
+
+def _seconds(expiry):
+  # memcache takes the expiry in whole seconds
+  return int(math.ceil(expiry)) if expiry else 0
+
+
+class LocalBackend(CacheBackend):
+  """A thread-safe LRU cache in this process. The values are not copied."""
+  
+  def __init__(self, capacity=10000):
+    self.cache = LRUCache(capacity)
+  
+  def get(self, key):
+    return self.cache.get(key)
+  
+  def set(self, key, value, expiry=0):
+    ttl = expires_at(expiry) - time.time() if expiry else None
+    self.cache.set(key, value, ttl)
+    return True
+  
+  def add(self, key, value, expiry=0):
+    ttl = expires_at(expiry) - time.time() if expiry else None
+    return self.cache.add(key, value, ttl)
+  
+  def incr(self, key, delta=1):
+    return self.cache.incr(key, delta)
+  
+  def delete(self, key):
+    return self.cache.delete(key)
+  
+  def clear(self):
+    self.cache.clear()
+  
+  def stats(self):
+    return self.cache.stats()
+
+
+_FOREVER = float('inf')
+
+
+def _digest(key):
+  if isinstance(key, unicode):
+    key = key.encode('utf-8')
+  return hashlib.md5(key).digest()
+
+
+class _InterProcessLock(object):
+  """Locks `fd` with fcntl in addition to a thread lock, since the fcntl
+  locks do not exclude the threads of a process."""
+  
+  def __init__(self, fd):
+    self.fd = fd
+    self.lock = threading.Lock()
+    try:
+      import fcntl
+    except ImportError:
+      fcntl = None
+    self.fcntl = fcntl
+  
+  def __enter__(self):
+    self.lock.acquire()
+    if self.fcntl is not None:
+      try:
+        self.fcntl.lockf(self.fd, self.fcntl.LOCK_EX)
+      except:
+        self.lock.release()
+        raise
+  
+  def __exit__(self, *exc_info):
+    try:
+      if self.fcntl is not None:
+        self.fcntl.lockf(self.fd, self.fcntl.LOCK_UN)
+    finally:
+      self.lock.release()
+
+
+class FileBackend(CacheBackend):
+  """Stores each item in a file under `directory`. Files are written to a
+  temporary file and renamed, so a reader never sees a partial item."""
+  
+  def __init__(self, directory=None):
+    if directory is None:
+      directory = user_temp_dir('raginei-cache')
+    self.directory = directory
+    try:
+      os.makedirs(directory, 0700)
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+    self._lock = None
+    self._lock_pid = None
+  
+  @property
+  def lock(self):
+    """Serializes add and incr among the threads and the processes."""
+    if self._lock is None or self._lock_pid != os.getpid():
+      fd = os.open(os.path.join(self.directory, '.lock'),
+        os.O_RDWR | os.O_CREAT, 0600)
+      self._lock = _InterProcessLock(fd)
+      self._lock_pid = os.getpid()
+    return self._lock
+  
+  def get_path(self, key):
+    return os.path.join(self.directory, _digest(key).encode('hex') + '.cache')
+  
+  def load(self, path):
+    try:
+      f = open(path, 'rb')
+    except IOError:
+      return None
+    try:
+      try:
+        expires, value = pickle.load(f)
+      except Exception:
+        return None
+    finally:
+      f.close()
+    if expires and expires <= time.time():
+      return None
+    return value
+  
+  def get(self, key):
+    return self.load(self.get_path(key))
+  
+  def set(self, key, value, expiry=0):
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+    try:
+      f = os.fdopen(fd, 'wb')
+      try:
+        pickle.dump((expires_at(expiry), value), f, pickle.HIGHEST_PROTOCOL)
+      finally:
+        f.close()
+      os.rename(tmp, self.get_path(key))
+    except:
+      try:
+        os.remove(tmp)
+      except OSError:
+        pass
+      raise
+    return True
+  
+  def add(self, key, value, expiry=0):
+    with self.lock:
+      if self.get(key) is not None:
+        return False
+      return self.set(key, value, expiry)
+  
+  def incr(self, key, delta=1):
+    path = self.get_path(key)
+    with self.lock:
+      try:
+        f = open(path, 'rb')
+      except IOError:
+        return None
+      try:
+        expires, value = pickle.load(f)
+      finally:
+        f.close()
+      if expires and expires <= time.time():
+        return None
+      value += delta
+      self.set(key, value, expires)
+      return value
+  
+  def delete(self, key):
+    try:
+      os.remove(self.get_path(key))
+    except OSError:
+      return False
+    return True
+  
+  def clear(self):
+    for filename in os.listdir(self.directory):
+      if filename.endswith('.cache'):
+        try:
+          os.remove(os.path.join(self.directory, filename))
+        except OSError:
+          pass
+
+
+class SharedMemoryBackend(CacheBackend):
+  """A hash table in a memory mapped file, shared by the processes on the
+  host, such as the prefork workers of a server.
+  
+  The file has `slots` slots of `slot_size` bytes. An item goes to one of
+  the `probes` slots after the hash of its key, replacing the one which
+  expires first when they are all used. Pickled values larger than
+  `slot_size` minus the 28 bytes of the slot header are not stored, and
+  set removes the old value of the key instead. The default slots take
+  values up to about 64KB in a sparse file of 128MB; pass a larger
+  `slot_size` to cache larger pages.
+  """
+  
+  MAGIC = 'RGSC'
+  HEADER = struct.Struct('<4sII')
+  # md5 of the key, expires, size of the value
+  SLOT_HEADER = struct.Struct('<16sdI')
+  EMPTY = '\0' * 16
+  
+  def __init__(self, path=None, slots=2048, slot_size=65536, probes=8):
+    if path is None:
+      path = os.path.join(user_temp_dir('raginei-cache'), 'cache.shm')
+    self.path = path
+    self.slots = slots
+    self.slot_size = slot_size
+    self.probes = min(probes, slots)
+    self.max_value_size = slot_size - self.SLOT_HEADER.size
+    self.size = self.HEADER.size + slots * slot_size
+    self._map = None
+    self._lock = None
+    self._pid = None
+  
+  def open(self):
+    """Maps the file, once in each process."""
+    if self._map is not None and self._pid == os.getpid():
+      return self._map
+    fd = os.open(self.path,
+      os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0600)
+    st = os.fstat(fd)
+    if hasattr(os, 'getuid') and (st.st_uid != os.getuid() or
+        st.st_mode & (stat.S_IRWXG | stat.S_IRWXO)):
+      # the values are unpickled
+      os.close(fd)
+      raise RuntimeError('%s is owned or accessible by another user' % (
+        self.path))
+    lock = _InterProcessLock(fd)
+    with lock:
+      header = os.read(fd, self.HEADER.size)
+      expected = self.HEADER.pack(self.MAGIC, self.slots, self.slot_size)
+      if header != expected or os.fstat(fd).st_size != self.size:
+        # a new file, or one made with another layout
+        os.ftruncate(fd, 0)
+        os.ftruncate(fd, self.size)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, expected)
+    self._map = mmap.mmap(fd, self.size)
+    self._lock = lock
+    self._pid = os.getpid()
+    return self._map
+  
+  def offsets(self, digest):
+    start = struct.unpack_from('<I', digest)[0] % self.slots
+    for i in xrange(self.probes):
+      yield self.HEADER.size + ((start + i) % self.slots) * self.slot_size
+  
+  def find(self, m, digest):
+    """Returns the offset of the live item of `digest`, or None."""
+    now = time.time()
+    for offset in self.offsets(digest):
+      d, expires, size = self.SLOT_HEADER.unpack_from(m, offset)
+      if d == digest:
+        if expires and expires <= now:
+          return None
+        return offset
+    return None
+  
+  def read(self, m, offset):
+    size = self.SLOT_HEADER.unpack_from(m, offset)[2]
+    start = offset + self.SLOT_HEADER.size
+    return pickle.loads(m[start:start + size])
+  
+  def write(self, m, digest, data, expires):
+    now = time.time()
+    target = None
+    # the slot which expires first, replaced when all the slots are used
+    victim = None
+    for offset in self.offsets(digest):
+      d, e, size = self.SLOT_HEADER.unpack_from(m, offset)
+      if d == digest:
+        target = offset
+        break
+      elif d == self.EMPTY or (e and e <= now):
+        if target is None:
+          target = offset
+      elif victim is None or (e or _FOREVER) < victim[1]:
+        victim = (offset, e or _FOREVER)
+    if target is None:
+      target = victim[0]
+    start = target + self.SLOT_HEADER.size
+    m[start:start + len(data)] = data
+    self.SLOT_HEADER.pack_into(m, target, digest, expires, len(data))
+  
+  def get(self, key):
+    return self.get_multi([key]).get(key)
+  
+  def get_multi(self, keys):
+    m = self.open()
+    result = {}
+    with self._lock:
+      for key in keys:
+        offset = self.find(m, _digest(key))
+        if offset is not None:
+          result[key] = self.read(m, offset)
+    return result
+  
+  def set(self, key, value, expiry=0):
+    return not self.set_multi({key: value}, expiry)
+  
+  def set_multi(self, mapping, expiry=0):
+    """Returns the keys which were not stored."""
+    m = self.open()
+    expires = expires_at(expiry)
+    failed = []
+    items = []
+    for key, value in mapping.iteritems():
+      data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+      if self.max_value_size < len(data):
+        failed.append(key)
+      else:
+        items.append((_digest(key), data))
+    with self._lock:
+      for digest, data in items:
+        self.write(m, digest, data, expires)
+      for key in failed:
+        # not to leave the old value readable
+        self.remove(m, _digest(key))
+    return failed
+  
+  def remove(self, m, digest):
+    offset = self.find(m, digest)
+    if offset is None:
+      return False
+    self.SLOT_HEADER.pack_into(m, offset, self.EMPTY, 0, 0)
+    return True
+  
+  def add(self, key, value, expiry=0):
+    m = self.open()
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if self.max_value_size < len(data):
+      return False
+    digest = _digest(key)
+    with self._lock:
+      if self.find(m, digest) is not None:
+        return False
+      self.write(m, digest, data, expires_at(expiry))
+    return True
+  
+  def incr(self, key, delta=1):
+    m = self.open()
+    digest = _digest(key)
+    with self._lock:
+      offset = self.find(m, digest)
+      if offset is None:
+        return None
+      value = self.read(m, offset) + delta
+      expires = self.SLOT_HEADER.unpack_from(m, offset)[1]
+      self.write(m, digest, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+        expires)
+    return value
+  
+  def delete(self, key):
+    m = self.open()
+    with self._lock:
+      return self.remove(m, _digest(key))
+  
+  def clear(self):
+    m = self.open()
+    with self._lock:
+      m[self.HEADER.size:] = '\0' * (self.size - self.HEADER.size)
@@ -13,6 +13,8 @@ from __future__ import with_statement
 class Context(object):
   
   context_stack = []
+  # changed whenever anything is registered, pushed or popped
+  version = 0
   
   def __init__(self):
     self.routes = {}
@@ -29,11 +31,13 @@ class Context(object):
   def push(cls):
     obj = cls()
     cls.context_stack.append(obj)
+    Context.version += 1
     return obj
   
   @classmethod
   def pop(cls):
     assert 2 <= len(cls.context_stack)
+    Context.version += 1
     return cls.context_stack.pop()
   
   def __enter__(self):
@@ -58,6 +62,7 @@ class Context(object):
   @classmethod
   def set_to_dict(cls, name, key, value):
     getattr(cls.context_stack[-1], name)[key] = value
+    Context.version += 1
 
   @classmethod
   def add_template_context_processor(cls, value):
@@ -86,6 +91,7 @@ class Context(object):
   @classmethod
   def append_to_list(cls, name, value):
     getattr(cls.context_stack[-1], name).append(value)
+    Context.version += 1
   
   @classmethod
   def get_routes(cls):
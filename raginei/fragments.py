@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+raginei.fragments
+=================
+
+:copyright: 2011 by najeira <najeira@gmail.com>.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import os
+import threading
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from jinja2 import Markup
+
+from .app import local, current_app, fetch, stream, LazyValue, remaining_time
+from .wrappers import DeadlineExceeded
+
+__all__ = ['Fragment', 'start_fragments', 'fetch_page', 'render_page',
+  'stream_page']
+
+
+class Fragment(object):
+  """A part of a page: `template` rendered with `values` and the dict
+  returned by `loader`.
+  
+  `loader` can be a function, which is called on a thread pool with
+  the locals of the request, a tasklet or a future. The fragments of
+  a page are loaded concurrently and the layout waits for each of them
+  only where it prints it. The form data and the body of the request are
+  parsed before the functions start::
+    
+    return render_page('index', {
+      'header': Fragment('header'),
+      'feed': Fragment('feed', load_feed, limit=20),
+      'ranking': Fragment('ranking', Ranking.query().fetch_async(10)),
+      })
+  """
+  
+  def __init__(self, template, loader=None, **values):
+    self.template = template
+    self.loader = loader
+    self.values = values
+  
+  def start(self):
+    """Starts loading and returns the rendered fragment as a LazyValue."""
+    loader = self.loader
+    if loader is None:
+      return LazyValue(lambda: self.render(None))
+    if getattr(loader, '__is_tasklet__', False):
+      loader = loader()
+    if hasattr(loader, 'get_result'):
+      # futures run on the event loop of the request thread
+      return LazyValue(lambda: self.render(loader.get_result()))
+    load_request_data()
+    result = get_pool().apply_async(run_with_locals,
+      (copy_locals(), self.load))
+    return LazyValue(lambda: wait(result))
+  
+  def load(self):
+    return self.render(self.loader())
+  
+  def render(self, data):
+    values = dict(self.values)
+    if data:
+      values.update(data)
+    return Markup(fetch(self.template, **values))
+
+
+_pool = None
+_pool_pid = None
+_lock = threading.Lock()
+
+
+def get_pool():
+  """Returns the thread pool of this process."""
+  global _pool, _pool_pid
+  if _pool is None or _pool_pid != os.getpid():
+    with _lock:
+      if _pool is None or _pool_pid != os.getpid():
+        _pool = ThreadPool(current_app.config.get('fragment_threads') or 8)
+        _pool_pid = os.getpid()
+  return _pool
+
+
+def load_request_data():
+  """Parses the form, the files and the body of the request, which are
+  loaded lazily and are not safe to load from several threads."""
+  request = getattr(local, 'request', None)
+  if request is not None:
+    request.data
+    request.files
+
+
+def copy_locals():
+  return dict(local.__storage__.get(local.__ident_func__(), {}))
+
+
+def install_locals(storage):
+  """Sets `storage` as the locals of the current thread unless it has its
+  own. Returns True if they were set."""
+  ident = local.__ident_func__()
+  if ident in local.__storage__:
+    return False
+  local.__storage__[ident] = dict(storage)
+  return True
+
+
+def run_with_locals(storage, func):
+  installed = install_locals(storage)
+  try:
+    return func()
+  finally:
+    if installed:
+      local.__release_local__()
+
+
+def iter_with_locals(storage, iterable):
+  """Iterates `iterable` with the locals of the request, which are
+  released before the server iterates the response."""
+  iterator = iter(iterable)
+  while True:
+    installed = install_locals(storage)
+    try:
+      chunk = iterator.next()
+    except StopIteration:
+      return
+    finally:
+      if installed:
+        local.__release_local__()
+    yield chunk
+
+
+def wait(result):
+  try:
+    return result.get(remaining_time())
+  except TimeoutError:
+    raise DeadlineExceeded()
+
+
+def start_fragments(fragments):
+  """Starts loading `fragments`, {name: Fragment}.
+  Returns {name: LazyValue} to be passed to the layout."""
+  return dict((name, fragment.start())
+    for name, fragment in fragments.iteritems())
+
+
+def fetch_page(template, fragments, **values):
+  values.update(start_fragments(fragments))
+  return fetch(template, **values)
+
+
+def render_page(template, fragments, **values):
+  mimetype = values.pop('_mimetype', None) or 'text/html'
+  return current_app.make_response(fetch_page(template, fragments, **values),
+    mimetype=mimetype)
+
+
+def stream_page(template, fragments, **values):
+  """Sends the layout as it is rendered. The rendering stops at each
+  fragment until it is ready, so the fragments are sent in order."""
+  mimetype = values.pop('_mimetype', None) or 'text/html'
+  values.update(start_fragments(fragments))
+  return current_app.response_class(
+    iter_with_locals(copy_locals(), stream(template, **values)),
+    mimetype=mimetype)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+raginei.jinja2bccache
+=====================
+
+:copyright: 2011 by najeira <najeira@gmail.com>.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import os
+import errno
+import hashlib
+import tempfile
+
+import jinja2
+from jinja2.bccache import BytecodeCache, Bucket
+
+from . import cache
+from .util import user_temp_dir
+
+__all__ = ['FileSystemBytecodeCache', 'MemcacheBytecodeCache']
+
+
+class BytecodeCacheBase(BytecodeCache):
+  """The keys include the jinja2 version and the checksum of the source,
+  so a changed template or a jinja2 upgrade never loads old code."""
+  
+  prefix = 'raginei.jinja2bccache'
+  
+  def get_bucket(self, environment, name, filename, source):
+    checksum = self.get_source_checksum(source)
+    key = hashlib.sha1('%s|%s|%s|%s' % (self.prefix, jinja2.__version__,
+      self.get_cache_key(name, filename), checksum)).hexdigest()
+    bucket = Bucket(environment, key, checksum)
+    self.load_bytecode(bucket)
+    return bucket
+
+
+class FileSystemBytecodeCache(BytecodeCacheBase):
+  """Stores the bytecode in `directory`, by default a directory only the
+  current user can access. Files are written to a temporary file and
+  renamed, so concurrent workers never read a partial file."""
+  
+  def __init__(self, directory=None):
+    if directory is None:
+      directory = user_temp_dir('raginei-jinja2')
+    self.directory = directory
+    try:
+      os.makedirs(directory, 0700)
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+  
+  def get_path(self, bucket):
+    return os.path.join(self.directory, bucket.key + '.cache')
+  
+  def load_bytecode(self, bucket):
+    try:
+      f = open(self.get_path(bucket), 'rb')
+    except IOError:
+      return
+    try:
+      bucket.load_bytecode(f)
+    finally:
+      f.close()
+  
+  def dump_bytecode(self, bucket):
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+    try:
+      f = os.fdopen(fd, 'wb')
+      try:
+        bucket.write_bytecode(f)
+      finally:
+        f.close()
+      os.rename(tmp, self.get_path(bucket))
+    except:
+      try:
+        os.remove(tmp)
+      except OSError:
+        pass
+      raise
+  
+  def clear(self):
+    for filename in os.listdir(self.directory):
+      if filename.endswith('.cache'):
+        try:
+          os.remove(os.path.join(self.directory, filename))
+        except OSError:
+          pass
+
+
+class MemcacheBytecodeCache(BytecodeCacheBase):
+  """Stores the bytecode through raginei.cache."""
+  
+  def __init__(self, expiry=0):
+    self.expiry = expiry
+  
+  def load_bytecode(self, bucket):
+    data = cache.cache_get(bucket.key)
+    if data is not None:
+      bucket.bytecode_from_string(data)
+  
+  def dump_bytecode(self, bucket):
+    cache.cache_set(bucket.key, bucket.bytecode_to_string(), self.expiry)
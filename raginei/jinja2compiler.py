@@ -15,13 +15,24 @@ import os
 import sys
 import re
 from os import path, listdir, makedirs
-import threading
-import Queue
 import logging
 import imp, marshal
+import struct
+import hashlib
+import tempfile
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
+import jinja2
+from raginei.jinja2deps import normalize_name, find_dependencies
 
 py_header = imp.get_magic() + u'\xff\xff\xff\xff'.encode('iso-8859-15')
 
+# the templates whose whitespace is stripped before compiling
+STRIP_EXTENSIONS = ('.html', '.htm', '.xhtml', '.xhtm')
+
 
 def compile_file(env, src_path, dst_path, encoding='utf-8', base_dir='', bytecode=False):
   """Compiles a Jinja2 template to python code.
@@ -32,6 +43,7 @@ def compile_file(env, src_path, dst_path, encoding='utf-8', base_dir='', bytecod
     `encoding`: template encoding.
     `base_dir`: the base path to be removed from the compiled template
       filename.
+  Returns the names of the templates the template depends on.
   """
   # Read the template file.
   src_file = file(src_path, 'rb')
@@ -44,23 +56,25 @@ def compile_file(env, src_path, dst_path, encoding='utf-8', base_dir='', bytecod
   finally:
     src_file.close()
   
-  if src_path.endswith( ('.html', '.htm', '.xhtml', '.xhtm') ):
+  if src_path.endswith(STRIP_EXTENSIONS):
     from raginei.jinja2loader import TemplateStrip
     source = TemplateStrip.strip(source)
   
   # Compile the template to raw Python code..
   name = src_path.replace(base_dir, '')
+  ast = env.parse(source, name=name, filename=name)
   if bytecode:
-    code = env.compile(source, name=name, filename=name, raw=False)
+    code = env.compile(ast, name=name, filename=name, raw=False)
     raw = py_header + marshal.dumps(code)
   else:
-    raw = env.compile(source, name=name, filename=name, raw=True)
+    raw = env.compile(ast, name=name, filename=name, raw=True)
   
   # Save to the destination.
   dst_file = open(dst_path, 'wb')
   dst_file.write(raw)
   dst_file.close()
-  print dst_path
+  logging.debug(dst_path)
+  return find_dependencies(ast)
 
 
 def compile_dir(env, src_path, dst_path, pattern=r'^[^\.].*\..*[^~]$',
@@ -98,41 +112,203 @@ def compile_dir(env, src_path, dst_path, pattern=r'^[^\.].*\..*[^~]$',
         dict(encoding=encoding, base_dir=base_dir, bytecode=bytecode))
 
 
-class ThreadPool(object):
-  def __init__(self, count):
-    self._queue = Queue.Queue(0) # infinite sized queue
-    self._threads = [threading.Thread(target=self._run) for _ in xrange(count)]
-    for thread in self._threads:
-      thread.start()
-  
-  def _run(self):
-    while 1:
-      func = self._queue.get()
-      if func is None:
-        break
-      try:
-        func[0](*func[1], **func[2])
-      except Exception as ex:
-        logging.exception(ex)
-  
-  def submit(self, func, *args, **kwds):
-    self._queue.put((func, args, kwds))
-  
-  def shutdown(self):
-    for _ in self._threads:
-      self._queue.put(None) # terminator
-    for thread in self._threads:
-      thread.join()
+MANIFEST_NAME = '.manifest.json'
+
+
+ENVIRONMENT_OPTIONS = ('block_start_string', 'block_end_string',
+  'variable_start_string', 'variable_end_string', 'comment_start_string',
+  'comment_end_string', 'line_statement_prefix', 'line_comment_prefix',
+  'trim_blocks', 'lstrip_blocks', 'newline_sequence', 'keep_trailing_newline',
+  'optimized')
+
+
+def environment_hash(env):
+  """Returns a hash of the settings of `env` which change the compiled
+  code, and of the whitespace stripping."""
+  from raginei.util import funcname
+  from raginei.jinja2loader import TemplateStrip
+  options = dict((name, getattr(env, name, None))
+    for name in ENVIRONMENT_OPTIONS)
+  options['extensions'] = sorted(env.extensions)
+  for name in ('autoescape', 'finalize'):
+    value = getattr(env, name, None)
+    options[name] = funcname(value) if callable(value) else value
+  options['strip'] = [STRIP_EXTENSIONS, TemplateStrip.version]
+  return hashlib.sha1(json.dumps(options, sort_keys=True)).hexdigest()
+
+
+def get_manifest_options(bytecode=False, env=None):
+  """Outputs made with other options are compiled again."""
+  options = {'jinja2': jinja2.__version__, 'bytecode': bytecode}
+  if bytecode:
+    options['python'] = imp.get_magic().encode('hex')
+  if env is not None:
+    options['environment'] = environment_hash(env)
+  return options
+
+
+def load_manifest(manifest_path, options):
+  """Returns {name: {'hash': ..., 'deps': [...], 'output': ...}}."""
+  try:
+    f = open(manifest_path, 'rb')
+  except IOError:
+    return {}
+  try:
+    data = json.load(f)
+  except ValueError:
+    return {}
+  finally:
+    f.close()
+  if data.get('options') != options:
+    return {}
+  return data.get('templates') or {}
+
+
+def save_manifest(manifest_path, options, templates):
+  fd, tmp = tempfile.mkstemp(dir=path.dirname(manifest_path))
+  f = os.fdopen(fd, 'wb')
+  try:
+    json.dump({'options': options, 'templates': templates}, f,
+      indent=1, sort_keys=True)
+  finally:
+    f.close()
+  os.rename(tmp, manifest_path)
 
 
-def compile_templates(jinja2_env, templates_dir, dest_dir, threads=1, bytecode=False):
-  thread_pool = ThreadPool(threads)
+def file_hash(file_path):
+  f = open(file_path, 'rb')
   try:
-    for func, args, kwds in compile_dir(
-      jinja2_env, templates_dir, dest_dir, bytecode=bytecode):
-      thread_pool.submit(func, *args, **kwds)
+    return hashlib.sha1(f.read()).hexdigest()
   finally:
-    thread_pool.shutdown()
+    f.close()
+
+
+_env = None
+
+
+def _compile_task(task):
+  src_path, dst_path, kwds = task
+  try:
+    return compile_file(_env, src_path, dst_path, **kwds)
+  except Exception, e:
+    logging.exception(e)
+    return None
+
+
+def run_tasks(env, tasks, processes=1):
+  """Compiles the templates in `processes` processes. The environment is
+  inherited by fork, so it does not have to be picklable."""
+  global _env
+  _env = env
+  try:
+    if processes <= 1 or len(tasks) <= 1 or not hasattr(os, 'fork'):
+      return map(_compile_task, tasks)
+    import multiprocessing
+    pool = multiprocessing.Pool(processes)
+    try:
+      return pool.map(_compile_task, tasks,
+        max(1, len(tasks) // (processes * 4)))
+    finally:
+      pool.close()
+      pool.join()
+  finally:
+    _env = None
+
+
+def write_archive(archive_path, dest_dir, templates):
+  """Packs the bytecode outputs of `templates` into one file read by
+  raginei.jinja2loader.ArchiveLoader."""
+  from raginei.jinja2loader import ARCHIVE_MAGIC
+  blobs = []
+  index = {}
+  offset = 0
+  for name in sorted(templates):
+    f = open(path.join(dest_dir, templates[name]['output']), 'rb')
+    try:
+      data = f.read()[len(py_header):]
+    finally:
+      f.close()
+    index[name] = (offset, len(data))
+    blobs.append(data)
+    offset += len(data)
+  index = marshal.dumps({'jinja2': jinja2.__version__, 'templates': index})
+  fd, tmp = tempfile.mkstemp(dir=path.dirname(path.abspath(archive_path)))
+  f = os.fdopen(fd, 'wb')
+  try:
+    f.write(struct.pack('<4s4sI', ARCHIVE_MAGIC, imp.get_magic(), len(index)))
+    f.write(index)
+    for data in blobs:
+      f.write(data)
+  finally:
+    f.close()
+  os.rename(tmp, archive_path)
+
+
+def compile_templates(jinja2_env, templates_dir, dest_dir, processes=1,
+                      bytecode=False, force=False, archive=None):
+  """Compiles the templates changed since the last run and the templates
+  extending, including or importing them. Returns the compiled names.
+  If `archive` is given, all the templates are also packed into it."""
+  if archive:
+    bytecode = True
+  options = get_manifest_options(bytecode, jinja2_env)
+  manifest_path = path.join(dest_dir, MANIFEST_NAME)
+  old = {} if force else load_manifest(manifest_path, options)
+  
+  templates = {}
+  sources = {}
+  changed = set()
+  for func, args, kwds in compile_dir(
+    jinja2_env, templates_dir, dest_dir, bytecode=bytecode):
+    src_name, dst_name = args[1], args[2]
+    name = normalize_name(src_name.replace(kwds['base_dir'], ''))
+    digest = file_hash(src_name)
+    entry = old.get(name)
+    templates[name] = {
+      'hash': digest,
+      'deps': entry['deps'] if entry else [],
+      'output': normalize_name(dst_name.replace(dest_dir, '')),
+      }
+    sources[name] = (src_name, dst_name, kwds)
+    if not entry or entry['hash'] != digest or not path.isfile(dst_name):
+      changed.add(name)
+  
+  # outputs of removed templates
+  removed = [name for name in old if name not in templates]
+  for name in removed:
+    try:
+      os.remove(path.join(dest_dir, old[name]['output']))
+    except (OSError, KeyError):
+      pass
+  
+  dependents = {}
+  for name, entry in templates.iteritems():
+    for dep in entry['deps']:
+      dependents.setdefault(dep, set()).add(name)
+  stack = list(changed) + removed
+  while stack:
+    for name in dependents.get(stack.pop(), ()):
+      if name not in changed:
+        changed.add(name)
+        stack.append(name)
+  
+  names = sorted(changed)
+  results = run_tasks(jinja2_env, [sources[name] for name in names],
+    processes)
+  compiled = []
+  for name, deps in zip(names, results):
+    if deps is None:
+      # compiled again on the next run
+      del templates[name]
+    else:
+      templates[name]['deps'] = deps
+      compiled.append(name)
+  save_manifest(manifest_path, options, templates)
+  if archive:
+    write_archive(archive, dest_dir, templates)
+  logging.info('raginei.jinja2compiler: compiled %d of %d templates' % (
+    len(compiled), len(templates)))
+  return compiled
 
 
 def main():
@@ -144,8 +320,13 @@ def main():
   parser.add_option('--src', type='string', default='templates')
   parser.add_option('--dest', type='string')
   parser.add_option('--root', type='string', default='.')
-  parser.add_option('--threads', type='int', default=1)
+  parser.add_option('--processes', type='int')
+  parser.add_option('--threads', type='int', help='same as --processes')
   parser.add_option('--bytecode', action='store_true', default=False)
+  parser.add_option('--archive', type='string',
+    help='also pack the templates into this file, implies --bytecode')
+  parser.add_option('--force', action='store_true', default=False,
+    help='compile all templates ignoring the manifest')
   
   options, args = parser.parse_args()
   options = dict([(k, v) for k, v in options.__dict__.iteritems()
@@ -188,8 +369,15 @@ def main():
   if not path.isdir(dest_dir):
     makedirs(dest_dir)
   
+  processes = options.get('processes') or options.get('threads')
+  if not processes:
+    from raginei.util import cpu_count
+    processes = cpu_count()
+  
+  logging.basicConfig(level=logging.INFO)
   compile_templates(application.jinja2_env, src_dir, dest_dir,
-    options['threads'], options['bytecode'])
+    processes, options['bytecode'], options['force'],
+    options.get('archive') and os.path.join(root_dir, options['archive']))
 
 
 if __name__ == '__main__':
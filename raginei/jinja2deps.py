@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+raginei.jinja2deps
+==================
+
+:copyright: 2011 by najeira <najeira@gmail.com>.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import os
+import sys
+import logging
+from jinja2 import meta, TemplateNotFound
+
+__all__ = ['normalize_name', 'find_references', 'find_dependencies',
+  'TemplateGraph']
+
+
+def normalize_name(name):
+  """'/foo/bar.html', 'foo\\bar.html' => 'foo/bar.html'"""
+  return name.replace('\\', '/').lstrip('/')
+
+
+def find_references(ast):
+  """Returns the names of the templates extended, included or imported
+  by the parsed template `ast`, as they are written. Dynamic names are
+  ignored."""
+  return set(name for name in meta.find_referenced_templates(ast) if name)
+
+
+def find_dependencies(ast):
+  """Returns the normalized names of the templates `ast` refers to."""
+  return sorted(set(normalize_name(name) for name in find_references(ast)))
+
+
+class TemplateGraph(object):
+  """The dependencies between the templates under `searchpath`.
+  
+  build() parses all the templates. Otherwise they are parsed when
+  preload or closure with `parse` reaches them.
+  Names are normalized, without the leading slash.
+  """
+  
+  def __init__(self, environment, searchpath, encoding='utf-8'):
+    self.environment = environment
+    self.searchpath = searchpath
+    self.encoding = encoding
+    self.deps = {}
+    # {name: the references in it, as they are written}
+    self.refs = {}
+    # {name: {reference to it as written: number of the templates}}
+    self.aliases = {}
+  
+  def __iter__(self):
+    return iter(sorted(self.deps))
+  
+  def __contains__(self, name):
+    return normalize_name(name) in self.deps
+  
+  def build(self):
+    self.deps = {}
+    self.refs = {}
+    self.aliases = {}
+    if not os.path.isdir(self.searchpath):
+      return self
+    for dirpath, dirnames, filenames in os.walk(self.searchpath):
+      dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+      for filename in filenames:
+        if filename.startswith('.') or filename.endswith('~'):
+          continue
+        self.update(os.path.relpath(os.path.join(dirpath, filename),
+          self.searchpath))
+    return self
+  
+  def update(self, name):
+    """Parses the template `name` again, after it was changed."""
+    name = normalize_name(name)
+    filename = os.path.join(self.searchpath, *name.split('/'))
+    self.remove_refs(name)
+    try:
+      f = open(filename, 'rb')
+    except IOError:
+      self.deps.pop(name, None)
+      return
+    try:
+      source = f.read().decode(self.encoding)
+      refs = find_references(self.environment.parse(source, name, filename))
+    except Exception, e:
+      logging.warn('raginei.jinja2deps: can not parse %s: %s' % (name, e))
+      refs = ()
+    finally:
+      f.close()
+    for ref in refs:
+      counts = self.aliases.setdefault(normalize_name(ref), {})
+      counts[ref] = counts.get(ref, 0) + 1
+    self.refs[name] = refs
+    self.deps[name] = sorted(set(normalize_name(ref) for ref in refs))
+  
+  def remove_refs(self, name):
+    """Forgets the references written in `name`."""
+    for ref in self.refs.pop(name, ()):
+      dep = normalize_name(ref)
+      counts = self.aliases[dep]
+      counts[ref] -= 1
+      if not counts[ref]:
+        del counts[ref]
+        if not counts:
+          del self.aliases[dep]
+  
+  def dependencies(self, name):
+    """Returns the templates `name` refers to directly."""
+    return self.deps.get(normalize_name(name), [])
+  
+  def closure(self, name, parse=False):
+    """Returns all the templates `name` depends on. With `parse`, the
+    templates not parsed yet are parsed on the way."""
+    result = set()
+    stack = [normalize_name(name)]
+    while stack:
+      current = stack.pop()
+      if parse and current not in self.deps:
+        self.update(current)
+      for dep in self.deps.get(current, ()):
+        if dep not in result:
+          result.add(dep)
+          stack.append(dep)
+    return result
+  
+  def dependents(self, name):
+    """Returns all the templates depending on `name`."""
+    reverse = {}
+    for parent, deps in self.deps.items():
+      for dep in deps:
+        reverse.setdefault(dep, []).append(parent)
+    result = set()
+    stack = [normalize_name(name)]
+    while stack:
+      for parent in reverse.get(stack.pop(), ()):
+        if parent not in result:
+          result.add(parent)
+          stack.append(parent)
+    return result
+  
+  def preload(self, environment, name):
+    """Loads `name` and the templates it depends on, by the names they
+    are referred by."""
+    environment.get_template(name)
+    for dep in self.closure(name, parse=True):
+      for alias in self.aliases.get(dep, ()):
+        try:
+          environment.get_template(alias)
+        except TemplateNotFound:
+          pass
+
+
+def main():
+  from optparse import OptionParser
+  from jinja2 import Environment
+  parser = OptionParser(usage='%prog [options] [template ...]')
+  parser.add_option('--src', type='string', default='templates')
+  parser.add_option('--extension', action='append', default=[],
+    help='import name of a jinja2 extension')
+  parser.add_option('--dependents', action='store_true', default=False,
+    help='show the templates depending on the templates')
+  parser.add_option('--closure', action='store_true', default=False,
+    help='show all the dependencies, not only the direct ones')
+  options, args = parser.parse_args()
+  
+  graph = TemplateGraph(Environment(extensions=options.extension),
+    os.path.abspath(options.src)).build()
+  for name in args or graph:
+    if options.dependents:
+      deps = sorted(graph.dependents(name))
+    elif options.closure:
+      deps = sorted(graph.closure(name))
+    else:
+      deps = graph.dependencies(name)
+    sys.stdout.write('%s: %s\n' % (normalize_name(name), ' '.join(deps)))
+
+
+if __name__ == '__main__':
+  main()
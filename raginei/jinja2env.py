@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+raginei.jinja2env
+=================
+
+:copyright: 2011 by najeira <najeira@gmail.com>.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from itertools import izip
+
+from jinja2 import Environment, Template
+from jinja2.runtime import Context, Undefined
+
+__all__ = ['decode_value', 'DecodingEnvironment']
+
+
+def decode_value(value, encoding='utf-8'):
+  """Decodes the byte strings in `value`, and in the lists, tuples and
+  dicts of it. The containers are copied, not changed."""
+  if isinstance(value, str):
+    return value.decode(encoding)
+  t = type(value)
+  if t is list or t is tuple:
+    items = [decode_value(v, encoding) for v in value]
+    for a, b in izip(items, value):
+      if a is not b:
+        return t(items)
+  elif t is dict:
+    items = [(k, decode_value(v, encoding)) for k, v in value.iteritems()]
+    for k, v in items:
+      if v is not value[k]:
+        return dict(items)
+  return value
+
+
+class DecodingContext(Context):
+  """Decodes the values the template looks up, so that the filters,
+  the operators and the tests see unicode, not UTF-8 byte strings."""
+  
+  def __init__(self, *args, **kwds):
+    super(DecodingContext, self).__init__(*args, **kwds)
+    self.decoded = {}
+    # {key: (value in vars, decoded value)}
+    self.decoded_vars = {}
+  
+  def resolve(self, key):
+    if key in self.vars:
+      # set by the template while rendering, and may be set again
+      value = self.vars[key]
+      entry = self.decoded_vars.get(key)
+      if entry is None or entry[0] is not value:
+        entry = self.decoded_vars[key] = (value,
+          decode_value(value, self.environment.template_encoding))
+      return entry[1]
+    try:
+      return self.decoded[key]
+    except KeyError:
+      pass
+    value = super(DecodingContext, self).resolve(key)
+    if not isinstance(value, Undefined):
+      value = decode_value(value, self.environment.template_encoding)
+      self.decoded[key] = value
+    return value
+
+
+class DecodingTemplate(Template):
+  
+  def new_context(self, vars=None, shared=False, locals=None):
+    context = super(DecodingTemplate, self).new_context(vars, shared, locals)
+    return DecodingContext(self.environment, context.parent, self.name,
+      self.blocks)
+
+
+class DecodingEnvironment(Environment):
+  """An Environment decoding the byte strings of the context and of the
+  attributes and the items read by the templates, instead of converting
+  the whole context before rendering."""
+  
+  template_class = DecodingTemplate
+  template_encoding = 'utf-8'
+  
+  def getattr(self, obj, attribute):
+    return decode_value(super(DecodingEnvironment, self).getattr(
+      obj, attribute), self.template_encoding)
+  
+  def getitem(self, obj, argument):
+    return decode_value(super(DecodingEnvironment, self).getitem(
+      obj, argument), self.template_encoding)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+raginei.jinja2ext
+=================
+
+:copyright: 2011 by najeira <najeira@gmail.com>.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import hashlib
+import base64
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+from . import cache, util
+
+
+class FragmentCacheExtension(Extension):
+  """Caches the rendered output of a block in the raginei.cache backend
+  and in an in-process LRU::
+    
+    {% cache "sidebar", 3600 %}...{% endcache %}
+    {% cache "nav", 3600, user.group %}...{% endcache %}
+  
+  The arguments are the key, the expiry in seconds and a version.
+  The key is made from the template name, the key and the version.
+  Rendering with `_force=True` in the context refreshes the fragments.
+  """
+  
+  tags = set(['cache'])
+  
+  def __init__(self, environment):
+    super(FragmentCacheExtension, self).__init__(environment)
+    environment.extend(
+      fragment_cache=util.LRUCache(500),
+      fragment_cache_expiry=300,
+      fragment_cache_enabled=not util.is_debug(),
+    )
+  
+  def parse(self, parser):
+    lineno = parser.stream.next().lineno
+    args = [parser.parse_expression()]
+    while parser.stream.skip_if('comma'):
+      args.append(parser.parse_expression())
+    if 3 < len(args):
+      parser.fail('cache takes at most 3 arguments', lineno)
+    while len(args) < 3:
+      args.append(nodes.Const(None))
+    args = [nodes.Const(parser.name)] + args + [nodes.ContextReference()]
+    body = parser.parse_statements(['name:endcache'], drop_needle=True)
+    return nodes.CallBlock(self.call_method('_cache', args),
+      [], [], body).set_lineno(lineno)
+  
+  def _cache(self, name, key, expiry, version, context, caller):
+    env = self.environment
+    if not env.fragment_cache_enabled:
+      return caller()
+    if expiry is None:
+      expiry = env.fragment_cache_expiry
+    key = fragment_key(name, key, version)
+    if not context.get('_force'):
+      data = env.fragment_cache.get(key)
+      if data is not None:
+        return data
+      data = cache.cache_get(key)
+      if data is not None:
+        env.fragment_cache.set(key, data, expiry)
+        return data
+    data = caller()
+    env.fragment_cache.set(key, data, expiry)
+    cache.cache_set(key, data, expiry)
+    return data
+
+
+def fragment_key(name, key, version=None):
+  key = 'raginei.jinja2ext.fragment_key:%s-%s-%s' % (
+    name, util.to_str(key), util.to_str(version))
+  if isinstance(key, unicode):
+    key = key.encode('utf-8')
+  return base64.b32encode(hashlib.sha1(key).digest())
@@ -7,10 +7,22 @@ raginei.jinja2loader
 :license: Apache License 2.0, see LICENSE for more details.
 """
 
+import os
 import re
+import imp
+import time
+import mmap
+import struct
+import marshal
+import jinja2
 from jinja2 import FileSystemLoader as JinjaFileSystemLoader
+from jinja2 import BaseLoader, TemplateNotFound
+from jinja2.loaders import split_template_path
 from jinja2.utils import internalcode
 
+from .util import LRUCache
+from .jinja2deps import normalize_name
+
 
 class TemplateStripMixin(object):
   
@@ -26,23 +38,69 @@ class TemplateStripMixin(object):
 
 
 class LoaderMixin(TemplateStripMixin):
+  """Keeps the compiled code of up to `cache_size` templates.
+  
+  If `check_interval` is given, the source of a template is checked for
+  changes at most once in that many seconds. Otherwise templates are
+  never reloaded.
+  """
   
   def __init__(self, *args, **kwds):
-    self._code_cache = {}
+    cache_size = kwds.pop('cache_size', None) or 400
+    self.check_interval = kwds.pop('check_interval', None)
+    super(LoaderMixin, self).__init__(*args, **kwds)
+    self._code_cache = LRUCache(cache_size)
   
   @internalcode
   def load(self, environment, name, globals=None):
-    if name in self._code_cache:
-      code, uptodate = self._code_cache[name]
-    else:
+    entry = self._code_cache.get(name)
+    if entry is None or not self.is_uptodate(name, entry):
       source, filename, uptodate = self.get_source(environment, name)
       code = self.compile(environment, source, name, filename)
-      self._code_cache[name] = (code, uptodate)
+      # [code, uptodate of the source, last checked at]
+      entry = [code, uptodate, time.time()]
+      self._code_cache.set(name, entry)
     return environment.template_class.from_code(
-      environment, code, globals or {}, uptodate)
+      environment, entry[0], globals or {}, self.make_uptodate(name, entry))
+  
+  def make_uptodate(self, name, entry):
+    def uptodate():
+      return self.is_uptodate(name, entry)
+    return uptodate
+  
+  def is_uptodate(self, name, entry):
+    if self._code_cache.peek(name) is not entry:
+      return False
+    if self.check_interval is None or entry[1] is None:
+      return True
+    now = time.time()
+    if now - entry[2] < self.check_interval:
+      return True
+    entry[2] = now
+    if entry[1]():
+      return True
+    self.invalidate(name)
+    return False
+  
+  def invalidate(self, name=None):
+    """Drops the compiled code of `name`, or of all templates."""
+    if name is None:
+      self._code_cache.clear()
+    else:
+      self._code_cache.delete(name)
+  
+  def cache_stats(self):
+    return self._code_cache.stats()
   
   def compile(self, environment, source, name, filename):
-    return environment.compile(source, name, filename)
+    bcc = environment.bytecode_cache
+    if bcc is None:
+      return environment.compile(source, name, filename)
+    bucket = bcc.get_bucket(environment, name, filename, source)
+    if bucket.code is None:
+      bucket.code = environment.compile(source, name, filename)
+      bcc.set_bucket(bucket)
+    return bucket.code
 
 
 class CodeLoaderMixin(LoaderMixin):
@@ -52,9 +110,32 @@ class CodeLoaderMixin(LoaderMixin):
 
 
 class ByteCodeLoaderMixin(LoaderMixin):
+  """Loads the files written by jinja2compiler --bytecode."""
+  
+  def get_source(self, environment, template):
+    pieces = split_template_path(template)
+    for searchpath in self.searchpath:
+      filename = os.path.join(searchpath, *pieces)
+      if not os.path.isfile(filename):
+        continue
+      f = open(filename, 'rb')
+      try:
+        data = f.read()
+      finally:
+        f.close()
+      mtime = os.path.getmtime(filename)
+      def uptodate():
+        try:
+          return os.path.getmtime(filename) == mtime
+        except OSError:
+          return False
+      return data, filename, uptodate
+    raise TemplateNotFound(template)
   
   def compile(self, environment, source, name, filename):
-    return source
+    if source[:4] != imp.get_magic():
+      raise ValueError('%s is compiled by another Python' % filename)
+    return marshal.loads(source[8:])
 
 
 class FileSystemLoaderBase(TemplateStripMixin, JinjaFileSystemLoader):
@@ -73,23 +154,110 @@ class FileSystemByteCodeLoader(ByteCodeLoaderMixin, FileSystemLoader):
   pass
 
 
+ARCHIVE_MAGIC = 'RGTA'
+
+_ARCHIVE_HEADER = struct.Struct('<4s4sI')
+
+
+class ArchiveLoader(BaseLoader):
+  """Loads the templates from an archive written by
+  jinja2compiler --archive.
+  
+  Only the index is read when the loader is created. The archive is
+  mapped into memory and the code of a template is unmarshalled the
+  first time it is loaded.
+  """
+  
+  has_source_access = False
+  
+  def __init__(self, path):
+    self.path = path
+    self._codes = {}
+    f = open(path, 'rb')
+    try:
+      magic, pymagic, size = _ARCHIVE_HEADER.unpack(
+        f.read(_ARCHIVE_HEADER.size))
+      if magic != ARCHIVE_MAGIC:
+        raise ValueError('%s is not a template archive' % path)
+      if pymagic != imp.get_magic():
+        raise ValueError('%s is compiled by another Python' % path)
+      index = marshal.loads(f.read(size))
+      if index['jinja2'] != jinja2.__version__:
+        raise ValueError('%s is compiled by jinja2 %s' % (
+          path, index['jinja2']))
+      self._index = index['templates']
+      self._base = _ARCHIVE_HEADER.size + size
+      if self._index:
+        self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      else:
+        self._data = ''
+    finally:
+      f.close()
+  
+  def list_templates(self):
+    return sorted(self._index)
+  
+  def get_code(self, name):
+    code = self._codes.get(name)
+    if code is None:
+      entry = self._index.get(normalize_name(name))
+      if entry is None:
+        raise TemplateNotFound(name)
+      offset = self._base + entry[0]
+      code = self._codes[name] = marshal.loads(
+        self._data[offset:offset + entry[1]])
+    return code
+  
+  @internalcode
+  def load(self, environment, name, globals=None):
+    return environment.template_class.from_code(
+      environment, self.get_code(name), globals or {}, None)
+
+
 class TemplateStrip(object):
+  """Removes the whitespace containing newlines around HTML tags and
+  Jinja delimiters, in one pass over the source.
   
-  E_BRACKET_OPEN = re.escape('{')
-  E_BRACKET_CLOSE = re.escape('}')
-  E_LT = re.escape('<')
-  E_GT = re.escape('>')
-  E_PERCENT = re.escape('%')
-  E_HASH = re.escape('#')
+  Other whitespace containing newlines is reduced to one newline.
+  Jinja tags, raw blocks, HTML comments and the content of pre,
+  textarea, script and style elements are kept as they are.
+  """
   
-  SPACE_RE = re.compile(r'(%s|(?:%s|%s|%s)%s)[\s\t]*[\r\n]+[\s\t\r\n]*' % (
-    E_GT, E_PERCENT, E_HASH, E_BRACKET_CLOSE, E_BRACKET_CLOSE,
-  ), re.MULTILINE)
+  # changed with the output, so the compiled templates are made again
+  version = 1
   
-  SPACE_RE2 = re.compile(r'([^%s])[\s\t]*[\r\n]+[\s\t\r\n]*(%s|%s(?:%s|%s|%s))' % (
-    E_BRACKET_OPEN, E_LT, E_BRACKET_OPEN, E_BRACKET_OPEN, E_PERCENT, E_HASH,
-  ), re.MULTILINE)
+  TOKEN_RE = re.compile(r'''
+      (?P<raw>\{%-?\s*raw\s*-?%\}.*?\{%-?\s*endraw\s*-?%\})
+    | (?P<jinja>\{\{.*?\}\}|\{%.*?%\}|\{\#.*?\#\})
+    | (?P<keep><(?P<elem>pre|textarea|script|style)\b.*?</(?P=elem)\s*>)
+    | (?P<comment><!--.*?-->)
+    | (?P<tag></?[a-zA-Z!](?:\{\{.*?\}\}|\{%.*?%\}|[^<>])*>)
+    | (?P<space>\s+)
+    | (?P<text>[^<{\s]+|[<{])
+    ''', re.DOTALL | re.IGNORECASE | re.VERBOSE)
   
   @classmethod
   def strip(cls, source):
-    return cls.SPACE_RE2.sub('\\1\\2', cls.SPACE_RE.sub('\\1', source))
+    out = []
+    append = out.append
+    space = None
+    # the start of the source counts as markup
+    markup = True
+    for m in cls.TOKEN_RE.finditer(source):
+      kind = m.lastgroup
+      value = m.group(kind)
+      if kind == 'space':
+        space = value
+        continue
+      is_markup = kind != 'text'
+      if space is not None:
+        if '\n' not in space and '\r' not in space:
+          append(space)
+        elif not markup and not is_markup:
+          append('\n')
+        space = None
+      append(value)
+      markup = is_markup
+    if space is not None and '\n' not in space and '\r' not in space:
+      append(space)
+    return u''.join(out)
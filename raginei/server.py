@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+"""
+raginei.server
+==============
+
+:copyright: 2011 by najeira <najeira@gmail.com>.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import os
+import sys
+import errno
+import time
+import signal
+import socket
+import select
+import logging
+import threading
+import Queue
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from werkzeug.wsgi import LimitedStream
+
+from .util import cpu_count
+
+__all__ = ['PreforkServer', 'run_prefork', 'ThreadPoolWSGIServer',
+  'run_threaded']
+
+
+class PreforkWSGIServer(BaseWSGIServer):
+  
+  multiprocess = True
+  
+  def __init__(self, host, port, app, backlog=128, **kwds):
+    self.request_queue_size = backlog
+    BaseWSGIServer.__init__(self, host, port, app, **kwds)
+
+
+class PreforkServer(object):
+  """A master process that forks `workers` processes accepting on one
+  shared listening socket.
+  
+  The application is warmed up in the master before forking, so the
+  loaded modules and templates are shared copy-on-write. Crashed workers
+  are restarted. SIGHUP replaces all workers with a new generation;
+  the old ones finish their current request before exiting.
+  SIGTERM and SIGINT shut down the whole server.
+  
+  The new workers are forked from the master, which has already imported
+  the application, so SIGHUP does not pick up changed Python code; it only
+  runs warmup again. Restart the master to deploy new code.
+  """
+  
+  check_interval = 0.5
+  
+  def __init__(self, host, port, app, workers=None, backlog=128,
+               graceful_timeout=30, handler=None):
+    self.app = app
+    self.num_workers = workers or cpu_count()
+    self.graceful_timeout = graceful_timeout
+    self.server = PreforkWSGIServer(host, port, app, backlog=backlog,
+      handler=handler)
+    self.server.socket.setblocking(0)
+    self.workers = {}
+    self.retiring = {}
+    self.running = False
+    self.reload_requested = False
+    self.alive = True
+  
+  def warmup(self):
+    warmup = getattr(self.app, 'warmup', None)
+    if warmup:
+      warmup()
+  
+  def serve_forever(self):
+    self.running = True
+    signal.signal(signal.SIGHUP, self.handle_reload)
+    signal.signal(signal.SIGTERM, self.handle_stop)
+    signal.signal(signal.SIGINT, self.handle_stop)
+    self.warmup()
+    logging.info('raginei.server: master %d listening on %s:%d' % (
+      os.getpid(), self.server.server_address[0],
+      self.server.server_address[1]))
+    try:
+      while self.running:
+        self.reap_workers()
+        if self.reload_requested:
+          self.reload_requested = False
+          self.reload()
+        self.spawn_workers()
+        time.sleep(self.check_interval)
+    finally:
+      self.stop()
+  
+  def handle_reload(self, signum, frame):
+    self.reload_requested = True
+  
+  def handle_stop(self, signum, frame):
+    self.running = False
+  
+  def reload(self):
+    """Replaces the workers. The modules are not imported again."""
+    logging.info('raginei.server: reloading workers')
+    self.retiring.update(self.workers)
+    self.workers = {}
+    self.warmup()
+    self.spawn_workers()
+    for pid in self.retiring:
+      self.kill_worker(pid, signal.SIGTERM)
+  
+  def spawn_workers(self):
+    while len(self.workers) < self.num_workers:
+      pid = os.fork()
+      if pid:
+        self.workers[pid] = time.time()
+        continue
+      # never return into the loop of the master, even on SystemExit
+      status = 1
+      try:
+        self.run_worker()
+        status = 0
+      except Exception, e:
+        logging.exception(e)
+      finally:
+        os._exit(status)
+  
+  def reap_workers(self):
+    while True:
+      try:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+      except OSError, e:
+        if e.errno == errno.ECHILD:
+          return
+        raise
+      if not pid:
+        return
+      if self.retiring.pop(pid, None) is None and \
+        self.workers.pop(pid, None) is not None:
+        logging.warn('raginei.server: worker %d exited with status %d' % (
+          pid, status))
+  
+  def kill_worker(self, pid, sig):
+    try:
+      os.kill(pid, sig)
+    except OSError, e:
+      if e.errno != errno.ESRCH:
+        raise
+  
+  def stop(self):
+    self.running = False
+    self.retiring.update(self.workers)
+    self.workers = {}
+    for pid in self.retiring.keys():
+      self.kill_worker(pid, signal.SIGTERM)
+    limit = time.time() + self.graceful_timeout
+    while self.retiring and time.time() < limit:
+      self.reap_workers()
+      time.sleep(0.1)
+    for pid in self.retiring.keys():
+      self.kill_worker(pid, signal.SIGKILL)
+    self.reap_workers()
+    self.server.server_close()
+  
+  def run_worker(self):
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, self.handle_worker_stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # let a request in progress finish instead of failing with EINTR
+    signal.siginterrupt(signal.SIGTERM, False)
+    server = self.server
+    sock = server.socket
+    while self.alive:
+      try:
+        ready = select.select([sock], [], [], 1.0)[0]
+      except select.error, e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+      if ready:
+        # Another worker may have accepted the connection already,
+        # the non-blocking accept just returns in that case.
+        server._handle_request_noblock()
+  
+  def handle_worker_stop(self, signum, frame):
+    self.alive = False
+
+
+_buffers = threading.local()
+
+
+def get_buffer(size):
+  """Returns a bytearray reused by the current thread."""
+  buf = getattr(_buffers, 'buf', None)
+  if buf is None or len(buf) < size:
+    buf = _buffers.buf = bytearray(size)
+  return buf
+
+
+def _load_sendfile():
+  """Returns sendfile(2) of the libc on Linux, None on the others, whose
+  sendfile takes other arguments."""
+  if not sys.platform.startswith('linux'):
+    return None
+  try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+      use_errno=True)
+    func = libc.sendfile64
+  except (ImportError, OSError, AttributeError):
+    return None
+  func.argtypes = [ctypes.c_int, ctypes.c_int,
+    ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+  func.restype = ctypes.c_ssize_t
+  return func
+
+
+_sendfile = _load_sendfile()
+
+
+def sendfile(sock, fd, offset, count):
+  """Sends `count` bytes of `fd` from `offset` to `sock`. Returns the
+  number of the bytes sent."""
+  import ctypes
+  pos = ctypes.c_int64(offset)
+  while True:
+    sent = _sendfile(sock.fileno(), fd, ctypes.byref(pos), count)
+    if 0 <= sent:
+      return sent
+    err = ctypes.get_errno()
+    if err == errno.EAGAIN:
+      # the socket with a timeout is non-blocking
+      if not select.select([], [sock], [], sock.gettimeout())[1]:
+        raise socket.timeout('timed out')
+    elif err != errno.EINTR:
+      raise OSError(err, os.strerror(err))
+
+
+class FileWrapper(object):
+  """wsgi.file_wrapper that can write the file to the connection directly.
+  
+  The file is read in blocks as usual, unless `direct` is set by
+  direct_file_app, which does it only when the application returned this
+  wrapper itself, not a body made by a middleware. Then iterating it
+  yields an empty string first, so the headers are sent, and the file is
+  copied with sendfile(2) on Linux or through the per-thread buffer, up
+  to the Content-Length of the response even if the file has grown.
+  """
+  
+  def __init__(self, file, buffer_size=65536, handler=None):
+    self.file = file
+    self.buffer_size = buffer_size
+    self.handler = handler
+    self.direct = False
+    # the Content-Length sent, set by direct_file_app
+    self.length = None
+  
+  def close(self):
+    if hasattr(self.file, 'close'):
+      self.file.close()
+  
+  def __iter__(self):
+    if not self.direct:
+      return iter(lambda: self.file.read(self.buffer_size), '')
+    return self.iter_direct()
+  
+  def iter_direct(self):
+    yield ''
+    self.handler.wfile.flush()
+    sock = self.handler.connection
+    if _sendfile is not None and hasattr(self.file, 'fileno'):
+      self.sendfile(sock)
+      return
+    remaining = self.length if self.length is not None else float('inf')
+    readinto = getattr(self.file, 'readinto', None)
+    if readinto is None:
+      while 0 < remaining:
+        data = self.file.read(min(self.buffer_size, remaining))
+        if not data:
+          break
+        sock.sendall(data)
+        remaining -= len(data)
+      return
+    buf = get_buffer(self.buffer_size)
+    view = memoryview(buf)
+    while 0 < remaining:
+      size = readinto(view[:min(len(buf), remaining)])
+      if not size:
+        break
+      sock.sendall(view[:size])
+      remaining -= size
+  
+  def sendfile(self, sock):
+    fd = self.file.fileno()
+    offset = self.file.tell()
+    size = os.fstat(fd).st_size
+    if self.length is not None:
+      size = min(size, offset + self.length)
+    while offset < size:
+      sent = sendfile(sock, fd, offset, size - offset)
+      if not sent:
+        break
+      offset += sent
+
+
+def direct_file_app(app):
+  """Wraps `app` given to the server, outside of all the middlewares, so
+  that a FileWrapper returned untouched writes the file directly."""
+  def application(environ, start_response):
+    headers = []
+    def start(status, response_headers, exc_info=None):
+      headers[:] = response_headers
+      return start_response(status, response_headers, exc_info)
+    result = app(environ, start)
+    if isinstance(result, FileWrapper) and result.handler is not None:
+      result.direct = True
+      for key, value in headers:
+        if key.lower() == 'content-length':
+          try:
+            result.length = int(value)
+          except ValueError:
+            result.direct = False
+    return result
+  return application
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+  """HTTP/1.1 request handler serving many requests per connection."""
+  
+  protocol_version = 'HTTP/1.1'
+  wbufsize = -1
+  disable_nagle_algorithm = True
+  
+  def setup(self):
+    self.timeout = self.server.idle_timeout
+    WSGIRequestHandler.setup(self)
+  
+  def make_environ(self):
+    environ = WSGIRequestHandler.make_environ(self)
+    if self.headers.get('Transfer-Encoding'):
+      self.close_connection = 1
+    else:
+      environ['wsgi.input'] = LimitedStream(self.rfile,
+        int(environ.get('CONTENT_LENGTH') or 0))
+    handler = self
+    environ['wsgi.file_wrapper'] = lambda file, buffer_size=65536: \
+      FileWrapper(file, buffer_size, handler)
+    self.environ = environ
+    return environ
+  
+  def handle_one_request(self):
+    self.environ = None
+    WSGIRequestHandler.handle_one_request(self)
+    stream = self.environ and self.environ['wsgi.input']
+    if isinstance(stream, LimitedStream):
+      # skip the body not read by the application
+      stream.exhaust()
+    if self.server.requests.qsize():
+      # do not keep a worker busy with an idle connection
+      # while other connections are waiting
+      self.close_connection = 1
+
+
+class ThreadPoolWSGIServer(BaseWSGIServer):
+  """A WSGI server handling connections with a fixed pool of threads.
+  
+  Accepted connections wait in a queue of `queue_size`; once it is full
+  the server stops accepting and new connections wait in the listen
+  backlog of the socket.
+  """
+  
+  multithread = True
+  daemon_threads = True
+  
+  def __init__(self, host, port, app, threads=8, backlog=128,
+               idle_timeout=15, queue_size=None, handler=None, **kwds):
+    self.request_queue_size = backlog
+    self.idle_timeout = idle_timeout
+    self.requests = Queue.Queue(queue_size or threads * 4)
+    BaseWSGIServer.__init__(self, host, port, direct_file_app(app),
+      handler=handler or KeepAliveRequestHandler, **kwds)
+    self.threads = []
+    for _ in xrange(threads):
+      thread = threading.Thread(target=self.process_queue)
+      thread.daemon = self.daemon_threads
+      thread.start()
+      self.threads.append(thread)
+  
+  def process_request(self, request, client_address):
+    self.requests.put((request, client_address))
+  
+  def process_queue(self):
+    while True:
+      item = self.requests.get()
+      if item is None:
+        break
+      request, client_address = item
+      try:
+        self.finish_request(request, client_address)
+      except Exception:
+        self.handle_error(request, client_address)
+      finally:
+        self.shutdown_request(request)
+  
+  def server_close(self):
+    BaseWSGIServer.server_close(self)
+    for _ in self.threads:
+      self.requests.put(None)
+
+
+def run_threaded(host, port, app, **options):
+  server = ThreadPoolWSGIServer(host, port, app, **options)
+  warmup = getattr(app, 'warmup', None)
+  if warmup:
+    warmup()
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+
+
+def run_prefork(host, port, app, **options):
+  server = PreforkServer(host, port, app, **options)
+  server.serve_forever()
@@ -13,7 +13,7 @@ import uuid
 from google.appengine.api import taskqueue
 from google.appengine.api import memcache
 from google.appengine.ext.ndb import in_transaction, Future
-from .app import request
+from .app import request, get_deadline
 from .util import wraps
 
 __all__ = [
@@ -48,8 +48,14 @@ def add(url, name=None, queue_name='default', transactional=False,
   
   task = taskqueue.Task(url=url, name=name, headers=headers, **kwds)
   
+  rpc = None
+  deadline = get_deadline()
+  if deadline is not None:
+    deadline.check()
+    rpc = taskqueue.create_rpc(deadline=deadline.remaining())
+  
   try:
-    task.add(queue_name, transactional=transactional)
+    task.add_async(queue_name, transactional=transactional, rpc=rpc).get_result()
   except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
     if not ignore_already:
       raise
@@ -7,14 +7,22 @@ raginei.util
 :license: Apache License 2.0, see LICENSE for more details.
 """
 
+from __future__ import with_statement
+
 import os
 import sys
+import stat
+import errno
 import logging
 import time
+import tempfile
+import threading
+from collections import OrderedDict
 
 
 __all__ = ['to_str', 'funcname', 'wraps', 'json_module', 'is_debug',
-  'measure_time', 'setup_gae_path', 'jinja2']
+  'measure_time', 'setup_gae_path', 'jinja2', 'Deadline', 'LRUCache',
+  'user_temp_dir', 'cpu_count']
 
 
 def to_str(v=None):
@@ -85,6 +93,164 @@ def measure_time(f):
   return wrapper
 
 
+class Deadline(object):
+  """A point in time by which the current request should be finished."""
+  
+  def __init__(self, timeout, margin=0.0, start=None):
+    self.start = start or time.time()
+    self.timeout = timeout
+    self.margin = margin
+    self.expires = self.start + timeout
+  
+  def __repr__(self):
+    return '<Deadline %.3fs remaining>' % self.remaining()
+  
+  def remaining(self):
+    return max(0.0, self.expires - time.time())
+  
+  def elapsed(self):
+    return time.time() - self.start
+  
+  @property
+  def expired(self):
+    return self.expires <= time.time()
+  
+  @property
+  def degraded(self):
+    """True if less than `margin` seconds are left.
+    Optional work should be skipped from now on."""
+    return self.expires - self.margin <= time.time()
+  
+  def check(self):
+    if self.expired:
+      from .wrappers import DeadlineExceeded
+      raise DeadlineExceeded()
+
+
+class LRUCache(object):
+  """A thread-safe mapping that discards the least recently used items
+  when it grows larger than `capacity`. Items set with a `ttl` expire
+  after that many seconds."""
+  
+  def __init__(self, capacity=1024):
+    self.capacity = capacity
+    self.hits = self.misses = self.evictions = 0
+    self._data = OrderedDict()
+    self._lock = threading.Lock()
+  
+  def __len__(self):
+    return len(self._data)
+  
+  def __contains__(self, key):
+    return key in self._data
+  
+  def get(self, key, default=None):
+    with self._lock:
+      try:
+        entry = self._data.pop(key)
+      except KeyError:
+        self.misses += 1
+        return default
+      if entry[1] is not None and entry[1] <= time.time():
+        self.misses += 1
+        return default
+      self._data[key] = entry
+      self.hits += 1
+      return entry[0]
+  
+  def peek(self, key, default=None):
+    """Returns the value without touching its position or the stats."""
+    entry = self._data.get(key)
+    if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+      return default
+    return entry[0]
+  
+  def set(self, key, value, ttl=None):
+    entry = (value, time.time() + ttl if ttl else None)
+    with self._lock:
+      self._data.pop(key, None)
+      self._data[key] = entry
+      if self.capacity < len(self._data):
+        self._data.popitem(last=False)
+        self.evictions += 1
+  
+  def _live(self, key):
+    # the caller holds the lock
+    entry = self._data.get(key)
+    if entry is not None and entry[1] is not None and entry[1] <= time.time():
+      return None
+    return entry
+  
+  def add(self, key, value, ttl=None):
+    """Sets the value only if `key` is not in the cache. Returns whether it
+    is set."""
+    entry = (value, time.time() + ttl if ttl else None)
+    with self._lock:
+      if self._live(key) is not None:
+        return False
+      self._data.pop(key, None)
+      self._data[key] = entry
+      if self.capacity < len(self._data):
+        self._data.popitem(last=False)
+        self.evictions += 1
+      return True
+  
+  def incr(self, key, delta=1):
+    """Adds `delta` to the value and returns it, keeping its position and
+    ttl. Returns None if `key` is not in the cache."""
+    with self._lock:
+      entry = self._live(key)
+      if entry is None:
+        return None
+      value = entry[0] + delta
+      self._data[key] = (value, entry[1])
+      return value
+  
+  def delete(self, key):
+    with self._lock:
+      return self._data.pop(key, None) is not None
+  
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+  
+  def stats(self):
+    return dict(size=len(self._data), capacity=self.capacity,
+      hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+def user_temp_dir(name):
+  """Returns `name`-<uid> in the temp directory, made with the mode 0700.
+  Raises RuntimeError if it is not a directory only the current user can
+  access, since the files in it are unpickled or loaded as code."""
+  tmpdir = tempfile.gettempdir()
+  if os.name == 'nt':
+    return os.path.join(tmpdir, name)
+  if not hasattr(os, 'getuid'):
+    raise RuntimeError('can not determine a safe temp directory,'
+      ' set the directory explicitly')
+  path = os.path.join(tmpdir, '%s-%d' % (name, os.getuid()))
+  try:
+    os.mkdir(path, stat.S_IRWXU)
+  except OSError, e:
+    if e.errno != errno.EEXIST:
+      raise
+  st = os.lstat(path)
+  if st.st_uid != os.getuid() or not stat.S_ISDIR(st.st_mode) or \
+    stat.S_IMODE(st.st_mode) != stat.S_IRWXU:
+    raise RuntimeError('temp directory %s has an incorrect owner,'
+      ' permissions or type' % path)
+  return path
+
+
+def cpu_count():
+  try:
+    import multiprocessing
+    return multiprocessing.cpu_count()
+  except (ImportError, NotImplementedError):
+    return 1
+
+
 def setup_gae_path(DIR_PATH):
   # from dev_appserver.py
   EXTRA_PATHS = [
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+raginei.watcher
+===============
+
+:copyright: 2011 by najeira <najeira@gmail.com>.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import os
+import time
+import errno
+import select
+import struct
+import logging
+import threading
+
+__all__ = ['Watcher', 'InotifyWatcher', 'PollingWatcher', 'create_watcher']
+
+
+class Watcher(object):
+  """Calls `callback` with the path of each changed file under `paths`
+  from a background thread. The path is None if the changes could not
+  be tracked, and everything should be treated as changed."""
+  
+  def __init__(self, paths, callback, interval=1.0):
+    self.paths = [os.path.abspath(p) for p in paths if os.path.isdir(p)]
+    self.callback = callback
+    self.interval = interval
+    self.running = False
+    self.thread = None
+  
+  def start(self):
+    self.running = True
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+  
+  def stop(self):
+    self.running = False
+  
+  def run(self):
+    raise NotImplementedError()
+  
+  def notify(self, path):
+    try:
+      self.callback(path)
+    except Exception, e:
+      logging.exception(e)
+
+
+class PollingWatcher(Watcher):
+  
+  def snapshot(self):
+    mtimes = {}
+    for top in self.paths:
+      for dirpath, dirnames, filenames in os.walk(top):
+        for filename in filenames:
+          path = os.path.join(dirpath, filename)
+          try:
+            mtimes[path] = os.stat(path).st_mtime
+          except OSError:
+            pass
+    return mtimes
+  
+  def run(self):
+    mtimes = self.snapshot()
+    while self.running:
+      time.sleep(self.interval)
+      current = self.snapshot()
+      for path, mtime in current.iteritems():
+        if mtimes.get(path) != mtime:
+          self.notify(path)
+      for path in mtimes:
+        if path not in current:
+          self.notify(path)
+      mtimes = current
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+IN_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+  IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _load_libc():
+  try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+      use_errno=True)
+    libc.inotify_init
+    return libc
+  except (ImportError, OSError, AttributeError):
+    return None
+
+
+class InotifyWatcher(Watcher):
+  
+  libc = None
+  
+  @classmethod
+  def is_available(cls):
+    if cls.libc is None:
+      cls.libc = _load_libc() or False
+    return bool(cls.libc)
+  
+  def __init__(self, *args, **kwds):
+    super(InotifyWatcher, self).__init__(*args, **kwds)
+    self.fd = None
+    self.watches = {}
+  
+  def add_watch(self, path):
+    import ctypes
+    for dirpath, dirnames, filenames in os.walk(path):
+      wd = self.libc.inotify_add_watch(self.fd, dirpath, IN_MASK)
+      if wd < 0:
+        err = ctypes.get_errno()
+        logging.warn('inotify_add_watch failed for %s: %s' % (
+          dirpath, os.strerror(err)))
+        continue
+      self.watches[wd] = dirpath
+  
+  def run(self):
+    import ctypes
+    self.fd = self.libc.inotify_init()
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init failed')
+    try:
+      for path in self.paths:
+        self.add_watch(path)
+      while self.running:
+        try:
+          ready = select.select([self.fd], [], [], self.interval)[0]
+        except select.error, e:
+          if e.args[0] == errno.EINTR:
+            continue
+          raise
+        if ready:
+          self.read_events(os.read(self.fd, 65536))
+    finally:
+      os.close(self.fd)
+  
+  def read_events(self, data):
+    offset = 0
+    while offset + _EVENT_HEADER.size <= len(data):
+      wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+      offset += _EVENT_HEADER.size
+      name = data[offset:offset + length].rstrip('\0')
+      offset += length
+      if mask & IN_Q_OVERFLOW:
+        self.notify(None)
+        continue
+      dirpath = self.watches.get(wd)
+      if dirpath is None:
+        continue
+      path = os.path.join(dirpath, name) if name else dirpath
+      if mask & IN_ISDIR:
+        if mask & (IN_CREATE | IN_MOVED_TO):
+          self.add_watch(path)
+        continue
+      self.notify(path)
+
+
+def create_watcher(paths, callback, interval=1.0):
+  """Returns an inotify watcher on Linux, a polling one otherwise."""
+  if InotifyWatcher.is_available():
+    return InotifyWatcher(paths, callback, interval)
+  return PollingWatcher(paths, callback, interval)
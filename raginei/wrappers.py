@@ -10,10 +10,11 @@ raginei.wrappers
 from werkzeug.wrappers import Request as RequestBase, Response as ResponseBase
 from werkzeug.utils import cached_property, redirect
 from werkzeug.contrib.wrappers import DynamicCharsetResponseMixin
-from werkzeug.exceptions import HTTPException
+from werkzeug.exceptions import HTTPException, ServiceUnavailable
 from .util import json_module
 
-__all__ = ['Request', 'Response', 'Found', 'MovedPermanently', 'HTTPException']
+__all__ = ['Request', 'Response', 'Found', 'MovedPermanently', 'HTTPException',
+  'DeadlineExceeded']
 
 class Request(RequestBase):
   url_rule = None
@@ -82,3 +83,7 @@ class Found(HTTPException):
 
 class MovedPermanently(Found):
   code = 301
+
+
+class DeadlineExceeded(ServiceUnavailable):
+  description = 'The request deadline has been exceeded.'
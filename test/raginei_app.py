@@ -306,6 +306,338 @@ class MyTest(GaeTestCase):
     self.assertEqual(res.status_code, 301)
     self.assertTrue(res.headers.get('Location', '').endswith('/foo/'))
 
+  
+  def test_deadline_none(self):
+    from raginei import route, get_deadline, remaining_time
+    app, c = self.init_app()
+    @route('/')
+    def foo():
+      self.assertTrue(get_deadline() is None)
+      self.assertEqual(remaining_time(), None)
+      return 'foo'
+    res = c.get('/')
+    self.assertEqual(res.status_code, 200)
+  
+  def test_deadline_config(self):
+    from raginei import route, get_deadline, remaining_time
+    app, c = self.init_app(request_deadline=10)
+    @route('/')
+    def foo():
+      deadline = get_deadline()
+      self.assertTrue(deadline)
+      self.assertFalse(deadline.expired)
+      self.assertFalse(deadline.degraded)
+      self.assertTrue(9 < remaining_time() <= 10)
+      return 'foo'
+    res = c.get('/')
+    self.assertEqual(res.status_code, 200)
+  
+  def test_deadline_header(self):
+    from raginei import route, remaining_time, check_deadline
+    app, c = self.init_app(request_deadline=10, trust_deadline_header=True)
+    remaining = []
+    @route('/')
+    def foo():
+      check_deadline()
+      remaining.append(remaining_time())
+      return 'foo'
+    res = c.get('/', headers={'X-Request-Deadline': '2'})
+    self.assertEqual(res.status_code, 200)
+    self.assertTrue(remaining[-1] <= 2)
+    # not below the minimum
+    for value in ('0', '-1', 'nan'):
+      res = c.get('/', headers={'X-Request-Deadline': value})
+      self.assertEqual(res.status_code, 200)
+      self.assertTrue(0.5 < remaining[-1] <= 1)
+    # not above the configured deadline
+    res = c.get('/', headers={'X-Request-Deadline': '100'})
+    self.assertTrue(9 < remaining[-1] <= 10)
+  
+  def test_deadline_header_untrusted(self):
+    from raginei import route, remaining_time
+    app, c = self.init_app(request_deadline=10)
+    remaining = []
+    @route('/')
+    def foo():
+      remaining.append(remaining_time())
+      return 'foo'
+    res = c.get('/', headers={'X-Request-Deadline': '0'})
+    self.assertEqual(res.status_code, 200)
+    self.assertTrue(9 < remaining[-1] <= 10)
+  
+  def test_deadline_exceeded(self):
+    from raginei import route, check_deadline
+    app, c = self.init_app(request_deadline=0.0001)
+    app.logging_exception = False
+    @route('/')
+    def foo():
+      import time
+      time.sleep(0.01)
+      check_deadline()
+      return 'foo'
+    res = c.get('/')
+    self.assertEqual(res.status_code, 503)
+  
+  def test_wait_futures_after_deadline(self):
+    import time
+    from raginei.app import local, register_future, wait_futures
+    from raginei.util import Deadline
+    class Future(object):
+      waited = False
+      def done(self):
+        return self.waited
+      def wait(self):
+        self.waited = True
+    local.deadline = Deadline(0.001)
+    self.addCleanup(local.__release_local__)
+    time.sleep(0.01)
+    futures = [Future(), Future()]
+    for f in futures:
+      register_future(f)
+    wait_futures()
+    self.assertEqual([f.waited for f in futures], [True, True])
+  
+  def test_prefork_server(self):
+    import os
+    import signal
+    import urllib2
+    from raginei import route
+    from raginei.server import PreforkServer
+    app, c = self.init_app()
+    @route('/')
+    def foo():
+      return 'pid:%d' % os.getpid()
+    server = PreforkServer('127.0.0.1', 0, app, workers=2)
+    port = server.server.server_address[1]
+    pid = os.fork()
+    if not pid:
+      try:
+        server.serve_forever()
+      finally:
+        os._exit(0)
+    try:
+      server.server.server_close()
+      data = None
+      for _ in xrange(50):
+        try:
+          data = urllib2.urlopen('http://127.0.0.1:%d/' % port).read()
+          break
+        except urllib2.URLError:
+          import time
+          time.sleep(0.1)
+      self.assertTrue(data and data.startswith('pid:'), data)
+      self.assertNotEqual(data, 'pid:%d' % pid)
+    finally:
+      os.kill(pid, signal.SIGTERM)
+      os.waitpid(pid, 0)
+  
+  def test_prefork_worker_exit(self):
+    import os
+    from raginei.server import PreforkServer
+    app, c = self.init_app()
+    class Server(PreforkServer):
+      def run_worker(self):
+        raise SystemExit(0)
+    server = Server('127.0.0.1', 0, app, workers=1)
+    self.addCleanup(server.server.server_close)
+    # the worker exits instead of returning into the caller
+    server.spawn_workers()
+    pid = server.workers.keys()[0]
+    self.assertEqual(os.waitpid(pid, 0), (pid, 1 << 8))
+  
+  def test_threaded_server_keep_alive(self):
+    import httplib
+    from werkzeug.wsgi import wrap_file
+    from raginei import route, request, current_app
+    from raginei.server import ThreadPoolWSGIServer
+    app, c = self.init_app()
+    @route('/')
+    def foo():
+      return 'foo'
+    @route('/file')
+    def file():
+      f = open(__file__.replace('.pyc', '.py'), 'rb')
+      import os
+      res = current_app.response_class(wrap_file(request.environ, f),
+        direct_passthrough=True)
+      res.content_length = os.path.getsize(f.name)
+      return res
+    @route('/grown')
+    def grown():
+      # as if the file has grown since the headers were made
+      f = open(__file__.replace('.pyc', '.py'), 'rb')
+      res = current_app.response_class(wrap_file(request.environ, f),
+        direct_passthrough=True)
+      res.content_length = 100
+      return res
+    from raginei import server as server_module
+    sent = []
+    sendfile = server_module.FileWrapper.sendfile
+    def counting_sendfile(self, sock):
+      sent.append(self.file.name)
+      return sendfile(self, sock)
+    server_module.FileWrapper.sendfile = counting_sendfile
+    self.addCleanup(setattr, server_module.FileWrapper, 'sendfile', sendfile)
+    server = ThreadPoolWSGIServer('127.0.0.1', 0, app, threads=2)
+    import threading
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+      conn = httplib.HTTPConnection('127.0.0.1', server.server_address[1])
+      conn.request('GET', '/', 'ignored body')
+      res = conn.getresponse()
+      self.assertEqual(res.status, 200)
+      self.assertEqual(res.read(), 'foo')
+      sock = conn.sock
+      conn.request('GET', '/file')
+      res = conn.getresponse()
+      self.assertEqual(res.status, 200)
+      self.assertEqual(res.read(), open(__file__.replace('.pyc', '.py'), 'rb').read())
+      self.assertEqual(len(sent), 1)
+      conn.request('GET', '/grown')
+      res = conn.getresponse()
+      self.assertEqual(res.read(),
+        open(__file__.replace('.pyc', '.py'), 'rb').read(100))
+      conn.request('GET', '/')
+      res = conn.getresponse()
+      self.assertEqual(res.read(), 'foo')
+      self.assertTrue(sock is conn.sock)
+      conn.close()
+    finally:
+      server.shutdown()
+      server.server_close()
+    # a middleware transforming the body gets the file as usual
+    del sent[:]
+    def upper(environ, start_response):
+      return [data.upper() for data in app(environ, start_response)]
+    server = ThreadPoolWSGIServer('127.0.0.1', 0, upper, threads=2)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+      conn = httplib.HTTPConnection('127.0.0.1', server.server_address[1])
+      conn.request('GET', '/file')
+      res = conn.getresponse()
+      self.assertEqual(res.read(),
+        open(__file__.replace('.pyc', '.py'), 'rb').read().upper())
+      self.assertEqual(sent, [])
+      conn.close()
+    finally:
+      server.shutdown()
+      server.server_close()
+  
+  def test_error_handler_cached(self):
+    app, c = self.init_app()
+    called = []
+    def handler(e):
+      called.append(e)
+      return app.response_class('not found', status=404)
+    handler.cacheable = True
+    app.error_handlers[404] = handler
+    for _ in xrange(3):
+      res = c.get('/unknown')
+      self.assertEqual(res.status_code, 404)
+      self.assertEqual(res.data, 'not found')
+    self.assertEqual(len(called), 1)
+  
+  def test_error_handler_not_cached(self):
+    from raginei import request
+    app, c = self.init_app()
+    def handler(e):
+      res = app.response_class('login?next=%s' % request.path, status=401)
+      res.set_cookie('next', request.path)
+      return res
+    app.error_handlers[404] = handler
+    for path in ('/foo', '/bar'):
+      res = c.get(path)
+      self.assertEqual(res.status_code, 401)
+      self.assertEqual(res.data, 'login?next=%s' % path)
+      self.assertTrue(res.headers.get('Set-Cookie'))
+  
+  def test_error_response_not_cached(self):
+    from raginei import route, abort
+    app, c = self.init_app()
+    @route('/<msg>')
+    def foo(msg):
+      abort(404, msg)
+    res = c.get('/foo')
+    self.assertEqual(res.status_code, 404)
+    self.assertTrue('foo' in res.data)
+    res = c.get('/bar')
+    self.assertEqual(res.status_code, 404)
+    self.assertTrue('bar' in res.data)
+  
+  def test_log_exception_rate_limited(self):
+    import logging
+    from raginei import route
+    app, c = self.init_app()
+    @route('/')
+    def foo():
+      raise ValueError('foo')
+    logged = []
+    class Handler(logging.Handler):
+      def emit(self, record):
+        logged.append(record)
+    handler = Handler()
+    logging.getLogger().addHandler(handler)
+    try:
+      for _ in xrange(3):
+        res = c.get('/')
+        self.assertEqual(res.status_code, 500)
+    finally:
+      logging.getLogger().removeHandler(handler)
+    self.assertEqual(len(logged), 1)
+    counters = app.exception_counters.values()
+    self.assertEqual(len(counters), 1)
+    self.assertEqual(counters[0][0], 3)
+    self.assertEqual(counters[0][1], 2)
+
+  
+  def test_url_cache(self):
+    from raginei import route, url
+    app, c = self.init_app()
+    @route('/')
+    def foo():
+      return '%s,%s,%s' % (url('bar', id=1), url('bar', id=1), url('bar', id=2))
+    @route('/bar/<int:id>')
+    def bar(id):
+      return ''
+    res = c.get('/')
+    self.assertEqual(res.data, '/bar/1,/bar/1,/bar/2')
+    self.assertEqual(app.url_cache.hits, 1)
+    self.assertEqual(len(app.url_cache), 2)
+    app.add_url_rule('/baz', 'baz', lambda: '')
+    self.assertEqual(len(app.url_cache), 0)
+  
+  def test_url_external(self):
+    from raginei import route, url
+    app, c = self.init_app()
+    @route('/bar')
+    def bar():
+      return url('bar', _external=True)
+    res = c.get('/bar')
+    self.assertEqual(res.data, 'http://localhost/bar')
+  
+  def test_url_precompile(self):
+    from raginei import route, url, url_adapter
+    app, c = self.init_app(url_precompile=True)
+    @route('/')
+    def foo():
+      ret = []
+      for values in [dict(id=1, name='a b'), dict(id=2, name=u'\u3042'),
+                     dict(id=3, name='c', q='x')]:
+        ret.append(url('bar', **values))
+        self.assertEqual(ret[-1], url_adapter.build('bar', values))
+      return ','.join(ret)
+    @route('/bar/<int:id>/<name>')
+    def bar(id, name):
+      return ''
+    res = c.get('/')
+    self.assertTrue('bar' in app.url_templates)
+    self.assertEqual(res.data,
+      '/bar/1/a%20b,/bar/2/%E3%81%82,/bar/3/c?q=x')
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,717 @@
+# -*- coding:utf-8 -*-
+
+import os
+import time
+import unittest
+from base import GaeTestCase
+
+
+class Name(str):
+  pass
+
+
+class FakeMemcache(object):
+  """Counts the calls to a dict, in place of the memcache module."""
+  
+  def __init__(self):
+    self.data = {}
+    self.calls = []
+  
+  def get(self, key):
+    self.calls.append('get')
+    return self.data.get(key)
+  
+  def set(self, key, value, time=0):
+    self.calls.append('set')
+    self.data[key] = value
+    return True
+  
+  def add(self, key, value, time=0):
+    self.calls.append('add')
+    if key in self.data:
+      return False
+    self.data[key] = value
+    return True
+  
+  def incr(self, key, delta=1):
+    self.calls.append('incr')
+    if key not in self.data:
+      return None
+    self.data[key] += delta
+    return self.data[key]
+  
+  def delete(self, key):
+    self.calls.append('delete')
+    return self.data.pop(key, None) is not None
+  
+  def get_multi(self, keys):
+    self.calls.append('get_multi')
+    return dict((k, self.data[k]) for k in keys if k in self.data)
+  
+  def set_multi(self, mapping, time=0):
+    self.calls.append('set_multi')
+    self.data.update(mapping)
+    return []
+  
+  def flush_all(self):
+    self.data.clear()
+
+
+class MyTest(GaeTestCase):
+  
+  def setUp(self):
+    super(MyTest, self).setUp()
+    # memoize does not read the cache on the development server
+    self.server_name = os.environ.get('SERVER_NAME')
+    os.environ['SERVER_NAME'] = 'example.com'
+  
+  def tearDown(self):
+    if self.server_name is None:
+      os.environ.pop('SERVER_NAME', None)
+    else:
+      os.environ['SERVER_NAME'] = self.server_name
+    super(MyTest, self).tearDown()
+  
+  def test_cache_key(self):
+    from raginei.cache import cache_key, memoize
+    def func(*args, **kwds):
+      pass
+    self.assertEqual(cache_key(func, 'a', 1), cache_key(func, u'a', 1L))
+    self.assertEqual(cache_key(func, [1, 2], set([3, 4])),
+      cache_key(func, (1, 2), set([4, 3])))
+    self.assertEqual(cache_key(func, a={'x': 1, 'y': 2}),
+      cache_key(func, a={'y': 2, 'x': 1}))
+    self.assertNotEqual(cache_key(func, 1), cache_key(func, '1'))
+    self.assertNotEqual(cache_key(func, 'a', 'b'), cache_key(func, 'a,b'))
+    self.assertNotEqual(cache_key(func, 1), cache_key(func, a=1))
+    key = cache_key(func, 1)
+    self.assertEqual(len(key), 32)
+    self.assertNotEqual(cache_key(memoize(version=2)(func), 1), key)
+    self.assertNotEqual(cache_key(memoize(namespace='ns')(func), 1), key)
+  
+  def use_fake_memcache(self):
+    from raginei import cache
+    from raginei.cachebackend import MemcacheBackend
+    fake = FakeMemcache()
+    self.addCleanup(cache.set_backend, cache.get_backend())
+    cache.set_backend(MemcacheBackend(fake))
+    return fake
+  
+  def test_memoize_multi(self):
+    from raginei.cache import memoize, memoize_multi
+    fake = self.use_fake_memcache()
+    calls = []
+    @memoize_multi()
+    def func(ids, suffix=''):
+      calls.append(ids)
+      return dict((i, '%d%s' % (i, suffix)) for i in ids if i != 4)
+    self.assertEqual(func([1, 2]), {1: '1', 2: '2'})
+    self.assertEqual(fake.calls, ['get_multi', 'set_multi'])
+    del fake.calls[:]
+    self.assertEqual(func([1, 2, 3, 4]), {1: '1', 2: '2', 3: '3'})
+    self.assertEqual(calls, [[1, 2], [3, 4]])
+    self.assertEqual(fake.calls, ['get_multi', 'set_multi'])
+    self.assertEqual(func([1], suffix='x'), {1: '1x'})
+    self.assertEqual(func.cache_stats()['hits'], 2)
+    # the same keys as memoize
+    @memoize()
+    def func(i, suffix=''):
+      raise AssertionError()
+    self.assertEqual(func(3), '3')
+  
+  def test_memoize_stale(self):
+    from raginei.cache import memoize, cache_key
+    fake = self.use_fake_memcache()
+    calls = []
+    @memoize(expiry=0.05, stale=60)
+    def func(a):
+      calls.append(a)
+      return len(calls)
+    self.assertEqual(func(1), 1)
+    self.assertEqual(func(1), 1)
+    time.sleep(0.1)
+    # another process is refreshing the value
+    lock = cache_key(func, 1) + ':lock'
+    fake.data[lock] = 1
+    self.assertEqual(func(1), 1)
+    self.assertEqual(func.cache_stats()['stales'], 1)
+    del fake.data[lock]
+    self.assertEqual(func(1), 2)
+    self.assertFalse(lock in fake.data)
+    self.assertEqual(func(1), 2)
+  
+  def test_memoize_deadline(self):
+    from raginei.app import local
+    from raginei.util import Deadline
+    from raginei.cache import memoize
+    fake = self.use_fake_memcache()
+    local.deadline = Deadline(0.01)
+    self.addCleanup(local.__release_local__)
+    time.sleep(0.02)
+    @memoize()
+    def func(a):
+      return a
+    self.assertEqual(func(1), 1)
+    # the value computed late is kept for the next requests
+    self.assertEqual(len(fake.data), 1)
+  
+  def test_memoize_envelope_key(self):
+    from raginei.cache import memoize
+    fake = self.use_fake_memcache()
+    def func(a):
+      return [a, 2, 3, 4]
+    self.assertEqual(memoize()(func)(1), [1, 2, 3, 4])
+    # the raw value cached above is not read as an envelope
+    self.assertEqual(memoize(stale=60)(func)(1), [1, 2, 3, 4])
+    self.assertEqual(memoize(beta=1)(func)(1), [1, 2, 3, 4])
+    self.assertEqual(memoize()(func)(1), [1, 2, 3, 4])
+    self.assertEqual(len(fake.data), 2)
+  
+  def test_memoize_lock_wait(self):
+    import threading
+    from raginei.cache import memoize, cache_key, default_serializer
+    fake = self.use_fake_memcache()
+    calls = []
+    @memoize(lock=True, lock_timeout=2)
+    def func(a):
+      calls.append(a)
+      return 'computed'
+    key = cache_key(func, 1)
+    fake.data[key + ':lock'] = 1
+    timer = threading.Timer(0.1, fake.data.__setitem__, (key, default_serializer.dumps('other')))
+    timer.start()
+    self.assertEqual(func(1), 'other')
+    self.assertEqual(calls, [])
+  
+  def test_memoize_singleflight(self):
+    import threading
+    from raginei.cache import memoize
+    calls = []
+    @memoize(lock=True)
+    def func(a):
+      calls.append(a)
+      time.sleep(0.1)
+      return a
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(func(1)))
+      for _ in xrange(5)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(calls, [1])
+    self.assertEqual(results, [1] * 5)
+  
+  def test_memoize_early_expiration(self):
+    from raginei.cache import memoize
+    self.use_fake_memcache()
+    calls = []
+    def func(a):
+      calls.append(a)
+      time.sleep(0.01)
+      return a
+    early = memoize(expiry=60, beta=1e9)(func)
+    early(1)
+    early(1)
+    self.assertEqual(len(calls), 2)
+    never = memoize(expiry=60, stale=60)(func)
+    never(2)
+    never(2)
+    self.assertEqual(len(calls), 3)
+  
+  def test_invalidate_tags(self):
+    from raginei.cache import memoize, memoize_multi, invalidate_tags
+    fake = self.use_fake_memcache()
+    calls = []
+    @memoize(namespace='user', tags=lambda user_id, page=1: ['user:%d' % user_id])
+    def func(user_id, page=1):
+      calls.append((user_id, page))
+      return len(calls)
+    @memoize_multi(namespace='user')
+    def multi(ids):
+      calls.append(ids)
+      return dict((i, i) for i in ids)
+    self.assertEqual(func(1), 1)
+    self.assertEqual(func(1, page=2), 2)
+    self.assertEqual(func(2), 3)
+    multi([1, 2])
+    self.assertEqual(len(calls), 4)
+    self.assertEqual(func(1), 1)
+    invalidate_tags('user:1')
+    self.assertEqual(func(1), 5)
+    self.assertEqual(func(1, page=2), 6)
+    self.assertEqual(func(2), 3)
+    multi([1, 2])
+    self.assertEqual(len(calls), 6)
+    invalidate_tags('user')
+    self.assertEqual(func(2), 7)
+    multi([1, 2])
+    self.assertEqual(len(calls), 8)
+    # the generations are read at once
+    del fake.calls[:]
+    multi([3, 4, 5])
+    self.assertEqual(fake.calls, ['get_multi', 'get_multi', 'set_multi'])
+  
+  def test_request_generations(self):
+    from werkzeug.test import Client
+    from raginei.app import Application, route
+    from raginei.wrappers import Response
+    from raginei.cache import memoize
+    fake = self.use_fake_memcache()
+    @memoize(tags=['a', 'b'])
+    def func(i):
+      return i
+    app = Application.instance(test=True)
+    @route('/')
+    def index():
+      func(1)
+      func(2)
+      func(3)
+      return 'ok'
+    c = Client(app, Response)
+    c.get('/')
+    self.assertEqual(fake.calls.count('get_multi'), 1)
+  
+  def test_memoize_local(self):
+    from raginei.cache import memoize, memoize_delete, add_invalidation_hook
+    calls = []
+    @memoize(local_expiry=0.1)
+    def func(a, b=1):
+      calls.append((a, b))
+      return a + b
+    self.assertEqual(func(1), 2)
+    self.assertEqual(func(1), 2)
+    self.assertEqual(func(2, b=2), 4)
+    self.assertEqual(calls, [(1, 1), (2, 2)])
+    stats = func.cache_stats()
+    self.assertEqual(stats['local_hits'], 1)
+    self.assertEqual(stats['local_size'], 2)
+    deleted = []
+    add_invalidation_hook(deleted.append)
+    memoize_delete(func, 1)
+    self.assertEqual(len(deleted), 1)
+    self.assertEqual(func(1), 2)
+    self.assertEqual(len(calls), 3)
+    time.sleep(0.15)
+    self.assertEqual(func(2, b=2), 4)
+    self.assertEqual(len(calls), 4)
+    self.assertEqual(func(1, _force=True), 2)
+    self.assertEqual(len(calls), 5)
+  
+  def test_memoize_local_size(self):
+    from raginei.cache import memoize, local_cache_delete, cache_key
+    calls = []
+    @memoize(local_expiry=60, local_size=2)
+    def func(a):
+      calls.append(a)
+      return a
+    for a in (1, 2, 3, 1):
+      func(a)
+    self.assertEqual(calls, [1, 2, 3, 1])
+    self.assertEqual(func.cache_stats()['local_evictions'], 2)
+    func(1)
+    self.assertEqual(len(calls), 4)
+    local_cache_delete(cache_key(func, 1))
+    func(1)
+    self.assertEqual(len(calls), 5)
+  
+  def test_serializer(self):
+    from raginei.cache import Serializer
+    serializer = Serializer(compress_threshold=100)
+    for value in (1, u'\u3042', [1, 'a', None], {'a': (1.5, True)}):
+      data = serializer.dumps(value)
+      self.assertEqual(data[0], 'M')
+      self.assertEqual(serializer.loads(data), value)
+    data = serializer.dumps(FakeMemcache)
+    self.assertEqual(data[0], 'P')
+    self.assertTrue(serializer.loads(data) is FakeMemcache)
+    from jinja2 import Markup
+    for value in (Markup(u'<b>\u3042</b>'), {'a': Markup(u'x')},
+                  [Name('a')], bytearray('ab')):
+      data = serializer.dumps(value)
+      self.assertEqual(data[0], 'P')
+      loaded = serializer.loads(data)
+      self.assertEqual(loaded, value)
+      self.assertTrue(type(loaded) is type(value))
+    loaded = serializer.loads(serializer.dumps({'a': Markup(u'x')}))
+    self.assertTrue(type(loaded['a']) is Markup)
+    value = 'abc' * 100
+    data = serializer.dumps(value)
+    self.assertEqual(data[0], 'm')
+    self.assertTrue(len(data) < 100)
+    self.assertEqual(serializer.loads(data), value)
+    self.assertRaises(ValueError, serializer.loads, 'x')
+    self.assertRaises(ValueError, serializer.loads, '')
+  
+  def test_memoize_chunks(self):
+    from raginei.cache import memoize, cache_key, Serializer
+    fake = self.use_fake_memcache()
+    serializer = Serializer(compress_threshold=None, chunk_size=100)
+    calls = []
+    @memoize(serializer=serializer)
+    def func(a):
+      calls.append(a)
+      return os.urandom(a)
+    value = func(250)
+    self.assertEqual(len(fake.data), 4)
+    self.assertEqual(fake.data[cache_key(func, 250)][0], 'C')
+    self.assertEqual(func(250), value)
+    self.assertEqual(calls, [250])
+    stats = func.cache_stats()
+    self.assertEqual(stats['chunked'], 1)
+    self.assertEqual(stats['bytes'], 256)
+    # a lost chunk is a miss
+    del fake.data[[k for k in fake.data if k.endswith(':1')][0]]
+    func(250)
+    self.assertEqual(calls, [250, 250])
+  
+  def test_memoize_bad_data(self):
+    from raginei.cache import memoize, cache_key
+    fake = self.use_fake_memcache()
+    calls = []
+    @memoize()
+    def func(a):
+      calls.append(a)
+      return a
+    # an empty value, and a raw value which looks like a chunk header
+    for data in ('', 'Cabc', 'Ca:b:c'):
+      fake.data[cache_key(func, 1)] = data
+      self.assertEqual(func(1), 1)
+    self.assertEqual(calls, [1, 1, 1])
+  
+  def test_memoize_compressed(self):
+    from raginei.cache import memoize, cache_key
+    fake = self.use_fake_memcache()
+    @memoize()
+    def func(a):
+      return 'a' * a
+    self.assertEqual(func(10000), 'a' * 10000)
+    self.assertTrue(len(fake.data[cache_key(func, 10000)]) < 100)
+    self.assertEqual(func(10000), 'a' * 10000)
+    self.assertEqual(func.cache_stats()['compressed'], 1)
+    self.assertEqual(func.cache_stats()['hits'], 1)
+    @memoize(serializer=False)
+    def func(a):
+      return [a]
+    func(1)
+    self.assertEqual(fake.data[cache_key(func, 1)], [1])
+
+  
+  def test_cache_backend_config(self):
+    import shutil
+    import tempfile
+    from raginei import cache
+    from raginei.app import Application
+    from raginei.cachebackend import FileBackend
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    self.addCleanup(cache.set_backend, cache.get_backend())
+    Application(cache_backend='file',
+      cache_backend_options={'directory': directory})
+    self.assertTrue(isinstance(cache.get_backend(), FileBackend))
+    cache.cache_set('a', 1)
+    self.assertEqual(cache.cache_get('a'), 1)
+    self.assertEqual(len(os.listdir(directory)), 1)
+
+
+class BackendTest(object):
+  """The tests all the backends pass."""
+  
+  # memcache expires the items by seconds
+  check_expiry = True
+  
+  def create_backend(self):
+    raise NotImplementedError()
+  
+  def setUp(self):
+    super(BackendTest, self).setUp()
+    self.backend = self.create_backend()
+    self.backend.clear()
+  
+  def test_get_set(self):
+    backend = self.backend
+    self.assertEqual(backend.get('a'), None)
+    backend.set('a', 1)
+    backend.set(u'b', {'x': [1, 'y']})
+    backend.set('c', 'x' * 1000)
+    self.assertEqual(backend.get('a'), 1)
+    self.assertEqual(backend.get(u'b'), {'x': [1, 'y']})
+    self.assertEqual(backend.get('c'), 'x' * 1000)
+    backend.set('a', 2)
+    self.assertEqual(backend.get('a'), 2)
+    backend.delete('a')
+    self.assertEqual(backend.get('a'), None)
+    backend.delete('a')
+  
+  def test_multi(self):
+    backend = self.backend
+    self.assertEqual(backend.get_multi(['a', 'b']), {})
+    backend.set_multi(dict(('k%d' % i, i) for i in range(10)))
+    self.assertEqual(backend.get_multi(['k1', 'k5', 'x']), {'k1': 1, 'k5': 5})
+  
+  def test_add_incr(self):
+    backend = self.backend
+    self.assertTrue(backend.add('a', 1))
+    self.assertFalse(backend.add('a', 2))
+    self.assertEqual(backend.get('a'), 1)
+    self.assertEqual(backend.incr('a'), 2)
+    self.assertEqual(backend.incr('a', 10), 12)
+    self.assertEqual(backend.get('a'), 12)
+    self.assertEqual(backend.incr('b'), None)
+    self.assertEqual(backend.get('b'), None)
+  
+  def test_expiry(self):
+    if not self.check_expiry:
+      return
+    backend = self.backend
+    backend.set('a', 1, 0.05)
+    backend.set('b', 1)
+    self.assertTrue(backend.add('c', 1, 0.05))
+    self.assertEqual(backend.get('a'), 1)
+    time.sleep(0.1)
+    self.assertEqual(backend.get('a'), None)
+    self.assertEqual(backend.get('b'), 1)
+    self.assertEqual(backend.incr('c'), None)
+    self.assertTrue(backend.add('c', 2))
+  
+  def test_threads(self):
+    import threading
+    backend = self.backend
+    backend.set('n', 0)
+    added = []
+    def run():
+      for i in range(50):
+        backend.incr('n')
+        if backend.add('once', 1):
+          added.append(1)
+    threads = [threading.Thread(target=run) for i in range(4)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(backend.get('n'), 200)
+    self.assertEqual(added, [1])
+  
+  def test_benchmark(self):
+    import logging
+    backend = self.backend
+    value = {'id': 1, 'name': 'x' * 100}
+    keys = ['key%d' % i for i in range(100)]
+    start = time.time()
+    for key in keys:
+      backend.set(key, value)
+    set_time = time.time() - start
+    start = time.time()
+    for key in keys:
+      backend.get(key)
+    get_time = time.time() - start
+    start = time.time()
+    self.assertEqual(len(backend.get_multi(keys)), 100)
+    multi_time = time.time() - start
+    logging.info('%s: set %.1fus get %.1fus get_multi %.1fus per key' % (
+      type(backend).__name__, set_time * 1e4, get_time * 1e4, multi_time * 1e4))
+
+
+class MemcacheBackendTest(BackendTest, unittest.TestCase):
+  
+  check_expiry = False
+  
+  def create_backend(self):
+    from raginei.cachebackend import MemcacheBackend
+    return MemcacheBackend(FakeMemcache())
+
+
+class PooledMemcacheBackendTest(BackendTest, unittest.TestCase):
+  
+  check_expiry = False
+  
+  def create_backend(self):
+    from raginei.cachebackend import MemcacheBackend, ClientPool
+    fake = FakeMemcache()
+    return MemcacheBackend(pool=ClientPool(lambda: fake, 2))
+  
+  def test_pool_wait(self):
+    import threading
+    from raginei.cachebackend import MemcacheBackend, ClientPool
+    class SlowMemcache(FakeMemcache):
+      def get(self, key):
+        time.sleep(0.05)
+        return FakeMemcache.get(self, key)
+    clients = []
+    def factory():
+      clients.append(SlowMemcache())
+      return clients[-1]
+    backend = MemcacheBackend(pool=ClientPool(factory, 2))
+    threads = [threading.Thread(target=backend.get, args=('a',))
+      for i in range(4)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(len(clients), 2)
+    stats = backend.stats()
+    self.assertEqual(stats['pool_created'], 2)
+    self.assertEqual(stats['pool_idle'], 2)
+    self.assertEqual(stats['pool_waits'], 2)
+    self.assertTrue(stats['pool_wait_time'] > 0.05)
+  
+  def test_pool_timeout(self):
+    from raginei.cachebackend import MemcacheBackend, ClientPool
+    pool = ClientPool(FakeMemcache, 1, timeout=0.01)
+    backend = MemcacheBackend(pool=pool)
+    client = pool.get()
+    self.assertEqual(backend.get('a'), None)
+    self.assertEqual(pool.stats()['timeouts'], 1)
+    pool.put(client)
+    self.assertTrue(backend.set('a', 1))
+    self.assertEqual(backend.get('a'), 1)
+  
+  def test_pool_deadline(self):
+    from raginei.app import local
+    from raginei.util import Deadline
+    from raginei.cachebackend import MemcacheBackend, ClientPool
+    pool = ClientPool(FakeMemcache, 1)
+    backend = MemcacheBackend(pool=pool)
+    client = pool.get()
+    local.deadline = Deadline(0.05)
+    self.addCleanup(local.__release_local__)
+    start = time.time()
+    # does not wait for the client after the deadline
+    self.assertEqual(backend.get('a'), None)
+    self.assertTrue(time.time() - start < 1)
+    self.assertEqual(pool.stats()['timeouts'], 1)
+    pool.put(client)
+    self.assertTrue(backend.set('a', 1))
+    self.assertEqual(backend.get('a'), 1)
+  
+  def test_errors(self):
+    from raginei.cachebackend import MemcacheBackend, ClientPool
+    class BrokenMemcache(FakeMemcache):
+      def get(self, key):
+        raise IOError('connection refused')
+    clients = []
+    def factory():
+      clients.append(BrokenMemcache())
+      return clients[-1]
+    backend = MemcacheBackend(pool=ClientPool(factory, 2))
+    self.assertEqual(backend.get('a'), None)
+    self.assertEqual(backend.get('a'), None)
+    self.assertEqual(backend.get_multi(['a']), {})
+    stats = backend.stats()
+    self.assertEqual(stats['errors'], 2)
+    # the failed clients are not reused
+    self.assertEqual(len(clients), 3)
+    self.assertEqual(stats['pool_created'], 1)
+    self.assertEqual(stats['pool_idle'], 1)
+
+
+class LocalBackendTest(BackendTest, unittest.TestCase):
+  
+  def create_backend(self):
+    from raginei.cachebackend import LocalBackend
+    return LocalBackend()
+  
+  def test_incr_threads(self):
+    import threading
+    backend = self.backend
+    backend.set('a', 0)
+    def incr():
+      for i in xrange(1000):
+        backend.incr('a')
+        backend.set('b', i)
+    threads = [threading.Thread(target=incr) for i in xrange(4)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(backend.get('a'), 4000)
+
+
+class FileBackendTest(BackendTest, unittest.TestCase):
+  
+  def create_backend(self):
+    import shutil
+    import tempfile
+    from raginei.cachebackend import FileBackend
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    return FileBackend(directory)
+
+
+class UserTempDirTest(unittest.TestCase):
+  
+  def setUp(self):
+    import tempfile
+    self.tempdir = tempfile.tempdir
+    tempfile.tempdir = tempfile.mkdtemp()
+  
+  def tearDown(self):
+    import shutil
+    import tempfile
+    shutil.rmtree(tempfile.tempdir)
+    tempfile.tempdir = self.tempdir
+  
+  def test_user_temp_dir(self):
+    import stat
+    import tempfile
+    from raginei.util import user_temp_dir
+    from raginei.cachebackend import FileBackend
+    path = user_temp_dir('raginei-test')
+    self.assertEqual(os.path.dirname(path), tempfile.tempdir)
+    self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0700)
+    self.assertEqual(user_temp_dir('raginei-test'), path)
+    os.chmod(path, 0777)
+    self.assertRaises(RuntimeError, user_temp_dir, 'raginei-test')
+    self.assertEqual(FileBackend().directory, user_temp_dir('raginei-cache'))
+
+
+class SharedMemoryBackendTest(BackendTest, unittest.TestCase):
+  
+  def create_backend(self):
+    import tempfile
+    from raginei.cachebackend import SharedMemoryBackend
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    self.addCleanup(os.remove, path)
+    return SharedMemoryBackend(path, slots=256)
+  
+  def test_processes(self):
+    backend = self.backend
+    backend.set('a', 1)
+    pid = os.fork()
+    if not pid:
+      # the parent sees the items set by the child
+      ok = False
+      try:
+        ok = backend.get('a') == 1 and backend.set('b', 2)
+      finally:
+        os._exit(0 if ok else 1)
+    self.assertEqual(os.waitpid(pid, 0)[1], 0)
+    self.assertEqual(backend.get('b'), 2)
+  
+  def test_permissions(self):
+    from raginei.cachebackend import SharedMemoryBackend
+    os.chmod(self.backend.path, 0666)
+    backend = SharedMemoryBackend(self.backend.path, slots=256)
+    self.assertRaises(RuntimeError, backend.get, 'a')
+  
+  def test_eviction(self):
+    from raginei.cachebackend import SharedMemoryBackend
+    backend = SharedMemoryBackend(self.backend.path, slots=4, slot_size=64,
+      probes=2)
+    self.assertFalse(backend.set('large', 'x' * 100))
+    for i in range(20):
+      backend.set('k%d' % i, i)
+    self.assertEqual(backend.get('k19'), 19)
+    self.assertTrue(len(backend.get_multi(['k%d' % i for i in range(20)])) <= 4)
+  
+  def test_too_large(self):
+    from raginei.cachebackend import SharedMemoryBackend
+    backend = SharedMemoryBackend(self.backend.path, slots=4, slot_size=64)
+    self.assertTrue(backend.set('a', 'small'))
+    self.assertFalse(backend.set('a', 'x' * 1000))
+    self.assertEqual(backend.get('a'), None)
+
+
+if __name__ == '__main__':
+  unittest.main()
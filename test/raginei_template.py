@@ -119,6 +119,571 @@ class MyTest(GaeTestCase):
     self.assertEqual(res.mimetype, 'image/gif')
     self.assertEqual(res.content_type, 'image/gif')
 
+  
+  def test_optional_context_processor(self):
+    from raginei.app import route, fetch, context_processor
+    app, c = self.init_app(request_deadline=0.0001)
+    @context_processor(optional=True)
+    def optional_processor(request):
+      return {'msg': 'optional'}
+    @route('/')
+    def hello_world():
+      return fetch('test_fetch', msg='degraded')
+    res = c.get('/')
+    self.assertEqual(res.status_code, 200)
+    self.assertEqual(res.data, 'degraded')
+  
+  def test_context_processor(self):
+    from raginei.app import route, fetch, context_processor
+    app, c = self.init_app()
+    @context_processor
+    def processor(request):
+      return {'msg': 'processor'}
+    @route('/')
+    def hello_world():
+      return fetch('test_fetch', msg='view')
+    res = c.get('/')
+    self.assertEqual(res.status_code, 200)
+    self.assertEqual(res.data, 'processor')
+  
+  def test_lazy_values(self):
+    from raginei.app import route, fetch, lazy
+    app, c = self.init_app()
+    calls = []
+    def compute(value):
+      calls.append(value)
+      return value
+    class Future(object):
+      def get_result(self):
+        calls.append('future')
+        return 'future'
+    @route('/')
+    def hello_world():
+      return fetch('test_lazy', show=False, value=lazy(compute, 'foo'))
+    @route('/show')
+    def show():
+      return fetch('test_lazy', show=True, value=lazy(compute, 'foo'))
+    @route('/future')
+    def future():
+      return fetch('test_lazy', show=True, value=lazy(Future()))
+    self.assertEqual(c.get('/').data, '')
+    self.assertEqual(calls, [])
+    self.assertEqual(c.get('/show').data, 'foo,foo,3')
+    self.assertEqual(calls, ['foo'])
+    self.assertEqual(c.get('/future').data, 'future,future,6')
+    self.assertEqual(calls, ['foo', 'future'])
+  
+  def test_lazy_context_processor(self):
+    from raginei.app import route, fetch, context_processor
+    app, c = self.init_app()
+    calls = []
+    @context_processor(keys=['value'])
+    def processor(request):
+      calls.append(request.path)
+      return {'value': 'bar'}
+    @route('/')
+    def hello_world():
+      return fetch('test_lazy', show=False)
+    @route('/show')
+    def show():
+      return fetch('test_lazy', show=True)
+    self.assertEqual(c.get('/').data, '')
+    self.assertEqual(calls, [])
+    self.assertEqual(c.get('/show').data, 'bar,bar,3')
+    self.assertEqual(calls, ['/show'])
+  
+  def test_template_globals(self):
+    from raginei.app import route, render, template_func
+    app, c = self.init_app(this_is_config='config')
+    @template_func
+    def limit():
+      return 'func'
+    @route('/')
+    def hello_world():
+      return render('test_globals')
+    @route('/override')
+    def override():
+      return render('test_globals', url=lambda endpoint: 'url',
+        config={'this_is_config': 'view'})
+    for _ in xrange(2):
+      res = c.get('/')
+      self.assertEqual(res.status_code, 200)
+      self.assertEqual(res.data, '/,config,func')
+    self.assertEqual(app.template_paths,
+      {('hello_world', 'test_globals'): '/test_globals.html'})
+    # the values of the view do not override the globals
+    self.assertEqual(c.get('/override').data, '/,config,func')
+    # a function registered after the first request
+    @template_func('limit')
+    def limit2():
+      return 'func2'
+    self.assertEqual(c.get('/').data, '/,config,func2')
+  
+  def test_fetch_byte_strings(self):
+    from raginei.app import route, fetch
+    app, c = self.init_app()
+    values = ['\xe3\x81\x82', u'\u3044']
+    nested = {'key': ('\xe3\x81\x86',)}
+    @route('/')
+    def hello_world():
+      ret = fetch('test_unicode', msg='\xe3\x81\x88', values=values,
+        nested=nested)
+      self.assertTrue(isinstance(ret, unicode))
+      return ret
+    res = c.get('/')
+    self.assertEqual(res.status_code, 200)
+    self.assertEqual(res.data.decode('utf-8'), u'\u3048,\u3042\u3044,\u3046')
+    self.assertEqual(values, ['\xe3\x81\x82', u'\u3044'])
+    self.assertEqual(nested, {'key': ('\xe3\x81\x86',)})
+  
+  def test_fetch_byte_strings_filters(self):
+    import warnings
+    from raginei.app import route, fetch
+    app, c = self.init_app()
+    class Obj(object):
+      title = '\xe3\x81\x8a'
+    rows = [{'name': '\xe3\x81\x82\xe3\x81\x84'}]
+    @route('/')
+    def hello_world():
+      return fetch('test_unicode_filters', m='\xe3\x81\x82\xe3\x81\x84',
+        row={'name': 'ab'}, rows=rows, values=['\xe3\x81\x82', 'b'],
+        obj=Obj())
+    with warnings.catch_warnings(record=True) as caught:
+      warnings.simplefilter('always')
+      res = c.get('/')
+    self.assertEqual(res.status_code, 200)
+    self.assertEqual(res.data.decode('utf-8'),
+      u'\u3042\u3044!,\u3042,2,eq,AB,2,\u3042/b,\u304a.')
+    self.assertEqual([w for w in caught
+      if issubclass(w.category, UnicodeWarning)], [])
+    self.assertEqual(rows, [{'name': '\xe3\x81\x82\xe3\x81\x84'}])
+  
+  def test_decoding_context_vars(self):
+    from raginei.jinja2env import DecodingEnvironment
+    env = DecodingEnvironment()
+    context = env.from_string(u'').new_context({'a': '\xe3\x81\x82'})
+    context.vars['items'] = ['\xe3\x81\x82'] * 3
+    items = context.resolve('items')
+    self.assertEqual(items, [u'\u3042'] * 3)
+    # decoded once while the value is the same
+    self.assertTrue(context.resolve('items') is items)
+    context.vars['items'] = ['\xe3\x81\x84']
+    self.assertEqual(context.resolve('items'), [u'\u3044'])
+    self.assertEqual(context.resolve('a'), u'\u3042')
+  
+  def test_fragment_cache(self):
+    from raginei.app import route, fetch, request
+    app, c = self.init_app(
+      jinja2_extensions=['raginei.jinja2ext.FragmentCacheExtension'])
+    app.jinja2_env.fragment_cache_enabled = True
+    @route('/')
+    def hello_world():
+      return fetch('test_fragment_cache', msg=request.args['msg'],
+        _force=bool(request.args.get('force')))
+    res = c.get('/?msg=foo')
+    self.assertEqual(res.data, 'foo')
+    res = c.get('/?msg=bar')
+    self.assertEqual(res.data, 'foo')
+    res = c.get('/?msg=bar&force=1')
+    self.assertEqual(res.data, 'bar')
+    res = c.get('/?msg=baz')
+    self.assertEqual(res.data, 'bar')
+
+  
+  def _write_template(self, dirname, name, source, mtime):
+    import os
+    path = os.path.join(dirname, name)
+    f = open(path, 'wb')
+    f.write(source)
+    f.close()
+    os.utime(path, (mtime, mtime))
+  
+  def test_loader_check_interval(self):
+    import shutil
+    import tempfile
+    from jinja2 import Environment
+    from raginei.jinja2loader import FileSystemLoader
+    dirname = tempfile.mkdtemp()
+    try:
+      self._write_template(dirname, 'a.html', 'foo', 1000)
+      env = Environment(loader=FileSystemLoader(dirname, check_interval=0))
+      self.assertEqual(env.get_template('a.html').render(), 'foo')
+      self._write_template(dirname, 'a.html', 'bar', 2000)
+      self.assertEqual(env.get_template('a.html').render(), 'bar')
+      env = Environment(loader=FileSystemLoader(dirname))
+      self.assertEqual(env.get_template('a.html').render(), 'bar')
+      self._write_template(dirname, 'a.html', 'baz', 3000)
+      self.assertEqual(env.get_template('a.html').render(), 'bar')
+    finally:
+      shutil.rmtree(dirname)
+  
+  def test_loader_cache_size(self):
+    import shutil
+    import tempfile
+    from jinja2 import Environment
+    from raginei.jinja2loader import FileSystemLoader
+    dirname = tempfile.mkdtemp()
+    try:
+      self._write_template(dirname, 'a.html', 'a', 1000)
+      self._write_template(dirname, 'b.html', 'b', 1000)
+      loader = FileSystemLoader(dirname, cache_size=1)
+      env = Environment(loader=loader, cache_size=0)
+      for name in ('a.html', 'b.html', 'b.html', 'a.html'):
+        self.assertEqual(env.get_template(name).render(), name[0])
+      stats = loader.cache_stats()
+      self.assertEqual(stats['size'], 1)
+      self.assertEqual(stats['hits'], 1)
+      self.assertEqual(stats['misses'], 3)
+      self.assertEqual(stats['evictions'], 2)
+    finally:
+      shutil.rmtree(dirname)
+  
+  def test_filesystem_bytecode_cache(self):
+    import os
+    import shutil
+    import tempfile
+    from jinja2 import Environment
+    from raginei.jinja2loader import FileSystemLoader
+    from raginei.jinja2bccache import FileSystemBytecodeCache
+    dirname = tempfile.mkdtemp()
+    try:
+      cachedir = os.path.join(dirname, 'cache')
+      self._write_template(dirname, 'a.html', '{{ 1 + 1 }}', 1000)
+      env = Environment(loader=FileSystemLoader(dirname),
+        bytecode_cache=FileSystemBytecodeCache(cachedir))
+      self.assertEqual(env.get_template('a.html').render(), '2')
+      self.assertEqual(len(os.listdir(cachedir)), 1)
+      # a new process loads the code without compiling
+      env = Environment(loader=FileSystemLoader(dirname),
+        bytecode_cache=FileSystemBytecodeCache(cachedir))
+      def compile(*args, **kwds):
+        raise AssertionError('compiled')
+      env.compile = compile
+      self.assertEqual(env.get_template('a.html').render(), '2')
+      # a changed source gets a new key
+      del env.compile
+      self._write_template(dirname, 'a.html', '{{ 2 + 2 }}', 2000)
+      env = Environment(loader=FileSystemLoader(dirname),
+        bytecode_cache=FileSystemBytecodeCache(cachedir))
+      self.assertEqual(env.get_template('a.html').render(), '4')
+      self.assertEqual(len(os.listdir(cachedir)), 2)
+      env.bytecode_cache.clear()
+      self.assertEqual(os.listdir(cachedir), [])
+    finally:
+      shutil.rmtree(dirname)
+  
+  def test_bytecode_cache_config(self):
+    import os
+    import shutil
+    import tempfile
+    from raginei.jinja2bccache import FileSystemBytecodeCache
+    # not to leave the directory in the real temp directory
+    self.addCleanup(setattr, tempfile, 'tempdir', tempfile.tempdir)
+    tempfile.tempdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tempfile.tempdir)
+    app, c = self.init_app(jinja2_bytecode_cache='filesystem')
+    self.assertTrue(isinstance(app.jinja2_env.bytecode_cache,
+      FileSystemBytecodeCache))
+    # not in the shared temp directory, other users could put code in it
+    directory = app.jinja2_env.bytecode_cache.directory
+    self.assertTrue(directory.endswith('-%d' % os.getuid()))
+    self.assertEqual(os.stat(directory).st_mode & 0777, 0700)
+  
+  def test_compile_templates_incremental(self):
+    import os
+    import shutil
+    import tempfile
+    from jinja2 import Environment
+    from raginei.jinja2compiler import compile_templates
+    dirname = tempfile.mkdtemp()
+    try:
+      src = os.path.join(dirname, 'src')
+      dest = os.path.join(dirname, 'dest')
+      os.makedirs(os.path.join(src, 'sub'))
+      os.makedirs(dest)
+      self._write_template(src, 'base.html', '{% block a %}{% endblock %}', 1000)
+      self._write_template(src, 'sub/child.html',
+        '{% extends "/base.html" %}{% block a %}a{% endblock %}', 1000)
+      self._write_template(src, 'other.html', 'other', 1000)
+      env = Environment()
+      self.assertEqual(compile_templates(env, src, dest, processes=2),
+        ['base.html', 'other.html', 'sub/child.html'])
+      self.assertTrue(os.path.isfile(os.path.join(dest, 'sub', 'child.html')))
+      self.assertEqual(compile_templates(env, src, dest), [])
+      self._write_template(src, 'base.html', '{% block a %}b{% endblock %}', 2000)
+      self.assertEqual(compile_templates(env, src, dest),
+        ['base.html', 'sub/child.html'])
+      os.remove(os.path.join(src, 'base.html'))
+      self.assertEqual(compile_templates(env, src, dest), ['sub/child.html'])
+      self.assertFalse(os.path.exists(os.path.join(dest, 'base.html')))
+      self.assertEqual(compile_templates(env, src, dest, bytecode=True),
+        ['other.html', 'sub/child.html'])
+      self.assertEqual(compile_templates(env, src, dest, bytecode=True), [])
+      # made again with other settings of the environment
+      env = Environment(autoescape=True)
+      self.assertEqual(compile_templates(env, src, dest, bytecode=True),
+        ['other.html', 'sub/child.html'])
+      env = Environment(autoescape=True, extensions=['jinja2.ext.do'])
+      self.assertEqual(compile_templates(env, src, dest, bytecode=True),
+        ['other.html', 'sub/child.html'])
+    finally:
+      shutil.rmtree(dirname)
+  
+  def test_compile_templates_strip(self):
+    import os
+    import shutil
+    import tempfile
+    from jinja2 import Environment
+    from raginei.jinja2compiler import compile_templates
+    from raginei.jinja2loader import FileSystemByteCodeLoader
+    dirname = tempfile.mkdtemp()
+    try:
+      src = os.path.join(dirname, 'src')
+      dest = os.path.join(dirname, 'dest')
+      os.makedirs(src)
+      os.makedirs(dest)
+      for name in ('a.html', 'a.xhtm', 'a.xml'):
+        self._write_template(src, name, '<a>\n  <b/>\n</a>', 1000)
+      compile_templates(Environment(), src, dest, bytecode=True)
+      env = Environment(loader=FileSystemByteCodeLoader(dest))
+      self.assertEqual(env.get_template('/a.html').render(), '<a><b/></a>')
+      self.assertEqual(env.get_template('/a.xhtm').render(), '<a><b/></a>')
+      self.assertEqual(env.get_template('/a.xml').render(),
+        '<a>\n  <b/>\n</a>')
+    finally:
+      shutil.rmtree(dirname)
+  
+  def test_template_archive(self):
+    import os
+    import shutil
+    import tempfile
+    from jinja2 import Environment, TemplateNotFound
+    from raginei.jinja2compiler import compile_templates
+    from raginei.jinja2loader import ArchiveLoader, FileSystemByteCodeLoader
+    dirname = tempfile.mkdtemp()
+    try:
+      src = os.path.join(dirname, 'src')
+      dest = os.path.join(dirname, 'dest')
+      archive = os.path.join(dirname, 'templates.rga')
+      os.makedirs(os.path.join(src, 'sub'))
+      os.makedirs(dest)
+      self._write_template(src, 'base.html', '<{% block a %}{% endblock %}>', 1000)
+      self._write_template(src, 'sub/child.html',
+        '{% extends "/base.html" %}{% block a %}{{ a }}{% endblock %}', 1000)
+      compile_templates(Environment(), src, dest, archive=archive)
+      env = Environment(loader=ArchiveLoader(archive))
+      self.assertEqual(env.loader.list_templates(),
+        ['base.html', 'sub/child.html'])
+      self.assertEqual(env.get_template('/sub/child.html').render(a=1), '<1>')
+      self.assertRaises(TemplateNotFound, env.get_template, 'foo.html')
+      env = Environment(loader=FileSystemByteCodeLoader(dest))
+      self.assertEqual(env.get_template('/sub/child.html').render(a=2), '<2>')
+    finally:
+      shutil.rmtree(dirname)
+  
+  def test_template_strip(self):
+    from raginei.jinja2loader import TemplateStrip
+    self.assertEqual(TemplateStrip.strip(
+      u'<div>\n  <p>\n    foo\n    bar\n  </p>\n</div>\n'),
+      u'<div><p>foo\nbar</p></div>')
+    self.assertEqual(TemplateStrip.strip(
+      u'{% if a > b %}\n  {{ a }} {{ b }}\n{% endif %}\n'),
+      u'{% if a > b %}{{ a }} {{ b }}{% endif %}')
+    source = u'<pre>\n  a\n  b\n</pre>'
+    self.assertEqual(TemplateStrip.strip(source), source)
+    source = u'<script>\n  var a = "\n  <b>";\n</script>'
+    self.assertEqual(TemplateStrip.strip(u'<p>\n' + source + u'\n</p>'),
+      u'<p>' + source + u'</p>')
+    source = u'<TEXTAREA>\n  a\n</TEXTAREA>'
+    self.assertEqual(TemplateStrip.strip(source), source)
+    source = u'{% raw %}\n  {{ a }}\n{% endraw %}'
+    self.assertEqual(TemplateStrip.strip(source), source)
+    self.assertEqual(TemplateStrip.strip(u'<a href="{{ f(\'>\') }}"\n  class="x">\n  y\n</a>'),
+      u'<a href="{{ f(\'>\') }}"\n  class="x">y</a>')
+  
+  def test_template_graph(self):
+    import os
+    import shutil
+    import tempfile
+    from jinja2 import Environment, FileSystemLoader
+    from raginei.jinja2deps import TemplateGraph
+    dirname = tempfile.mkdtemp()
+    try:
+      os.mkdir(os.path.join(dirname, 'sub'))
+      self._write_template(dirname, 'layout.html',
+        '{% include "/sub/partial.html" %}{% block a %}{% endblock %}', 1000)
+      self._write_template(dirname, 'sub/partial.html',
+        '{% from "macros.html" import m %}{{ m() }}', 1000)
+      self._write_template(dirname, 'macros.html', '{% macro m() %}m{% endmacro %}', 1000)
+      self._write_template(dirname, 'page.html',
+        '{% extends "/layout.html" %}{% block a %}a{% endblock %}', 1000)
+      env = Environment(loader=FileSystemLoader(dirname))
+      graph = TemplateGraph(env, dirname).build()
+      self.assertEqual(list(graph),
+        ['layout.html', 'macros.html', 'page.html', 'sub/partial.html'])
+      self.assertEqual(graph.dependencies('/page.html'), ['layout.html'])
+      self.assertEqual(graph.closure('page.html'),
+        set(['layout.html', 'sub/partial.html', 'macros.html']))
+      self.assertEqual(graph.dependents('macros.html'),
+        set(['layout.html', 'sub/partial.html', 'page.html']))
+      graph.preload(env, '/page.html')
+      self.assertEqual(sorted(env.cache.keys()),
+        ['/layout.html', '/page.html', '/sub/partial.html', 'macros.html'])
+      self._write_template(dirname, 'layout.html', '{% block a %}{% endblock %}', 2000)
+      graph.update('layout.html')
+      self.assertEqual(graph.dependents('macros.html'), set(['sub/partial.html']))
+      self.assertFalse('sub/partial.html' in graph.aliases)
+      # parsed on demand
+      graph = TemplateGraph(env, dirname)
+      self.assertEqual(graph.closure('page.html', parse=True),
+        set(['layout.html']))
+      self.assertEqual(list(graph), ['layout.html', 'page.html'])
+    finally:
+      shutil.rmtree(dirname)
+  
+  def test_preload_templates(self):
+    import os
+    from raginei.app import route, render
+    app, c = self.init_app(preload_templates=True)
+    @route('/')
+    def hello_world():
+      return render('test_page')
+    res = c.get('/')
+    self.assertEqual(res.data, '<foo>')
+    self.assertTrue('/test_page.html' in app.preloaded_templates)
+    # only the templates reached from the rendered one are parsed
+    self.assertEqual(list(app.template_graph),
+      ['test_layout.html', 'test_page.html', 'test_partial.html'])
+    app.on_file_changed(os.path.join(app.template_path, 'test_partial.html'))
+    self.assertFalse('/test_page.html' in app.preloaded_templates)
+    app.warmup()
+    self.assertTrue('/test_fetch.html' in app.preloaded_templates)
+  
+  def test_fragments(self):
+    import time
+    from raginei.app import route, request
+    from raginei.fragments import Fragment, render_page, stream_page
+    app, c = self.init_app()
+    class Future(object):
+      def get_result(self):
+        return {'value': 'future'}
+    def loader():
+      time.sleep(0.2)
+      return {'value': request.path}
+    def fragments():
+      return {
+        'header': Fragment('test_page_fragment', name='header', value='-'),
+        'feed': Fragment('test_page_fragment', loader, name='feed'),
+        'ranking': Fragment('test_page_fragment', loader, name='ranking'),
+        }
+    @route('/')
+    def index():
+      return render_page('test_page_layout', fragments())
+    @route('/stream')
+    def streamed():
+      page = fragments()
+      page['ranking'] = Fragment('test_page_fragment', Future(), name='ranking')
+      return stream_page('test_page_layout', page)
+    start = time.time()
+    res = c.get('/')
+    self.assertTrue(time.time() - start < 0.35)
+    self.assertEqual(res.data, '[header:-|feed:/|ranking:/]')
+    res = c.get('/stream')
+    self.assertEqual(res.data, '[header:-|feed:/stream|ranking:future]')
+  
+  def test_error_templates(self):
+    from raginei.app import route, abort
+    app, c = self.init_app(error_templates={404: '/test_error.html'})
+    @route('/<msg>')
+    def index(msg):
+      abort(404, msg)
+    for msg in ('first', 'second'):
+      res = c.get('/' + msg)
+      self.assertEqual(res.status_code, 404)
+      self.assertEqual(res.data, '404:%s|/%s' % (msg, msg))
+  
+  def test_error_templates_cached(self):
+    app, c = self.init_app(error_templates={404: '/test_error.html'},
+      cache_error_templates=True)
+    for path in ('/foo/', '/bar/'):
+      res = c.get(path)
+      self.assertEqual(res.status_code, 404)
+    self.assertTrue(res.data.endswith('|/foo/'))
+    self.assertEqual(len(app.error_responses), 1)
+  
+  def test_fragments_form(self):
+    from raginei.app import route, request
+    from raginei.fragments import Fragment, render_page
+    from raginei.ext.csrf import exempt
+    app, c = self.init_app()
+    loaded = []
+    def loader():
+      # parsed in the request thread, not by the loaders
+      loaded.append('form' in request._get_current_object().__dict__)
+      return {'value': request.form['q']}
+    @route('/form', methods=['POST'])
+    @exempt
+    def form():
+      return render_page('test_page_layout', {
+        'header': Fragment('test_page_fragment', loader, name='header'),
+        'feed': Fragment('test_page_fragment', loader, name='feed'),
+        'ranking': Fragment('test_page_fragment', name='ranking', value='-'),
+        })
+    res = c.post('/form', data={'q': 'x'})
+    self.assertEqual(res.data, '[header:x|feed:x|ranking:-]')
+    self.assertEqual(loaded, [True, True])
+  
+  def _test_watcher(self, cls):
+    import os
+    import time
+    import shutil
+    import tempfile
+    import threading
+    dirname = tempfile.mkdtemp()
+    try:
+      os.mkdir(os.path.join(dirname, 'sub'))
+      self._write_template(dirname, 'sub/a.html', 'a', 1000)
+      changed = []
+      event = threading.Event()
+      def callback(path):
+        changed.append(path)
+        event.set()
+      watcher = cls([dirname], callback, interval=0.05)
+      watcher.start()
+      time.sleep(0.2)
+      self._write_template(dirname, 'sub/a.html', 'b', 2000)
+      event.wait(5)
+      watcher.stop()
+      self.assertTrue(os.path.join(dirname, 'sub', 'a.html') in changed, changed)
+    finally:
+      shutil.rmtree(dirname)
+  
+  def test_polling_watcher(self):
+    from raginei.watcher import PollingWatcher
+    self._test_watcher(PollingWatcher)
+  
+  def test_inotify_watcher(self):
+    from raginei.watcher import InotifyWatcher
+    if InotifyWatcher.is_available():
+      self._test_watcher(InotifyWatcher)
+  
+  def test_file_changed_invalidates_templates(self):
+    import os
+    from raginei.app import route, render
+    app, c = self.init_app(
+      jinja2_loader='raginei.jinja2loader.FileSystemLoader')
+    @route('/')
+    def hello_world():
+      return render('test_fetch', msg='foo')
+    res = c.get('/')
+    self.assertEqual(res.data, 'foo')
+    loader = app.jinja2_env.loader
+    self.assertEqual(loader.cache_stats()['size'], 1)
+    app.on_file_changed(os.path.join(app.template_path, 'test_fetch.html'))
+    self.assertEqual(loader.cache_stats()['size'], 0)
+    res = c.get('/')
+    self.assertEqual(res.data, 'foo')
+
 
 if __name__ == '__main__':
   unittest.main()
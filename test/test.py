@@ -11,7 +11,7 @@ from optparse import OptionParser
 
 def usage():
   print 'test.py  [-t testsuite] [-v verbosity] [-x xmlrunner]'
-  print '    -t   run specific testsuite (app|template|all)'
+  print '    -t   run specific testsuite (app|template|cache|all)'
   print '    -v   verbosity (0|1|2)'
   print '    -x   xmlrunner'
 
@@ -24,7 +24,7 @@ def main():
     help="verbosity (0|1|2). default is 1")
   parser.add_option("-t", "--testsuite", action="store",
     type="string", dest="testsuite", default="all",
-    help="run specific testsuite (app|template|all). default is all")
+    help="run specific testsuite (app|template|cache|all). default is all")
   opts, args = parser.parse_args()
   tests = suite(opts.testsuite)
   if opts.verbosity > 1:
@@ -40,6 +40,7 @@ def suite(testsuite='all'):
   
   import raginei_app
   import raginei_template
+  import raginei_cache
   
   if testsuite in ('all', 'app'):
     tests.addTest(unittest.makeSuite(raginei_app.MyTest))
@@ -47,6 +48,13 @@ def suite(testsuite='all'):
   if testsuite in ('all', 'template'):
     tests.addTest(unittest.makeSuite(raginei_template.MyTest))
   
+  if testsuite in ('all', 'cache'):
+    tests.addTest(unittest.makeSuite(raginei_cache.MyTest))
+    for name in ('MemcacheBackendTest', 'PooledMemcacheBackendTest',
+      'LocalBackendTest', 'FileBackendTest', 'SharedMemoryBackendTest',
+      'UserTempDirTest'):
+      tests.addTest(unittest.makeSuite(getattr(raginei_cache, name)))
+  
   return tests
 
 if __name__ == '__main__':